@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares disk footprint and read/write throughput of TFRecord compression
+codecs supported by mneflow.produce_tfrecords.
+
+Usage: python compression.py [savepath] [n_epochs] [n_ch] [n_t]
+"""
+import sys
+import time
+import tempfile
+import numpy as np
+import tensorflow as tf
+import mneflow
+
+
+def run(savepath, n_epochs=2000, n_ch=306, n_t=250, n_classes=4):
+    # MEG-like data: smooth signals with additive noise
+    rng = np.random.RandomState(0)
+    X = np.cumsum(rng.randn(n_epochs, n_ch, n_t), axis=-1)
+    X += rng.randn(n_epochs, n_ch, n_t)
+    y = rng.randint(n_classes, size=n_epochs)
+    print('codec   size, MB   write, rec/s   read, rec/s')
+    for codec in [None, 'ZLIB', 'GZIP']:
+        out_name = 'bench_' + str(codec)
+        t0 = time.time()
+        meta = mneflow.produce_tfrecords((X, y), savepath, out_name,
+                                         overwrite=True, fs=250.,
+                                         val_size=.1, compression=codec)
+        write_rate = n_epochs / (time.time() - t0)
+        size = sum(meta['shards'][path]['n_bytes']
+                   for path in meta['train_paths'])
+
+        dataset = mneflow.Dataset(meta, train_batch=200)
+        reader = tf.data.TFRecordDataset(meta['train_paths'],
+                                         compression_type=meta['compression'])
+        reader = reader.batch(200).map(dataset._parse_batch)
+        batch = reader.make_one_shot_iterator().get_next()
+        n_read = 0
+        with tf.Session() as sess:
+            t0 = time.time()
+            while True:
+                try:
+                    n_read += len(sess.run(batch['y']))
+                except tf.errors.OutOfRangeError:
+                    break
+            read_rate = n_read / (time.time() - t0)
+        print('%-6s %9.1f %14.0f %13.0f' % (codec, size / 2.**20,
+                                             write_rate, read_rate))
+
+
+if __name__ == '__main__':
+    savepath = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp() + '/'
+    dims = [int(arg) for arg in sys.argv[2:5]]
+    run(savepath, *dims)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drains the mneflow.Dataset input pipeline without a model and reports the
+throughput of each stage and the bottleneck.
+
+Usage: python pipeline.py [savepath data_id] [decim]
+
+If savepath and data_id are given, the dataset described by the metadata
+saved there is used, otherwise a synthetic dataset is produced.
+"""
+import sys
+import tempfile
+import numpy as np
+import mneflow
+
+
+def synthetic(savepath, n_epochs=2000, n_ch=306, n_t=250, n_classes=4):
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_epochs, n_ch, n_t)
+    y = rng.randint(n_classes, size=n_epochs)
+    return mneflow.produce_tfrecords((X, y), savepath, 'bench_pipeline',
+                                     overwrite=True, fs=250., val_size=.1)
+
+
+def run(meta, decim=None, n_batches=20):
+    dataset = mneflow.Dataset(meta, train_batch=200, decim=decim)
+    return dataset.profile(n_batch=200, n_batches=n_batches)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        meta = mneflow.load_meta(sys.argv[1], data_id=sys.argv[2])
+        decim = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    else:
+        meta = synthetic(tempfile.mkdtemp() + '/')
+        decim = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    run(meta, decim=decim)
@@ -3,17 +3,35 @@
 """
 Defines mneflow.Dataset object
 """
+import os
+import time
+import hashlib
 import tensorflow as tf
 import numpy as np
 
+#  Storage dtypes of the data matrix: numpy dtype, tensorflow dtype
+_DTYPES = {'float32': ('<f4', tf.float32),
+           'float16': ('<f2', tf.float16),
+           'int16': ('<i2', tf.int16)}
+
+#  Read buffer of each shard reader in bytes. Large sequential reads reduce
+#  the number of requests on network filesystems.
+_READ_BUFFER = 8 * 2**20
+
 
 class Dataset(object):
     """TFRecords dataset from TFRecords files using the metadata.
 
+    If the data were produced with backend='numpy', the dataset is read
+    from memory-mapped .npy files instead.
         """
 
     def __init__(self, h_params, train_batch=200, class_subset=None,
-                 combine_classes=False, pick_channels=None, decim=None):
+                 combine_classes=False, pick_channels=None, decim=None,
+                 cycle_length=4, deterministic=True, prefetch=2,
+                 val_batch=None, ram_cache=None, disk_cache=None,
+                 shuffle_size=2**27, seed=None, class_weights=None,
+                 crop=None, jitter=0, noise=0., folds=False):
 
         """
         Initialize tf.data.TFRdatasets
@@ -44,100 +62,1077 @@ class Dataset(object):
 
         decim : NoneType, int, optional
                 Decimation factor. Defaults to None.
+
+        cycle_length : int, optional
+                Number of TFRecord files read in parallel. Records from
+                these files are interleaved, the next files are opened
+                ahead of time to hide the latency of network filesystems.
+                If 1, files are read one after another. Not used with
+                backend='numpy'. Defaults to 4.
+
+        deterministic : bool, optional
+                If False, records are taken from whichever file is ready
+                first, which avoids stalls on slow reads at the cost of
+                a non-reproducible order. Defaults to True.
+
+        prefetch : int, optional
+                Number of batches prepared in the background while the
+                model runs. Defaults to 2.
+
+        val_batch : NoneType, int, optional
+                Batch size used when evaluating the model. The validation
+                set is not repeated, models iterate over it batch by batch
+                so that memory use is bounded by val_batch. If None,
+                train_batch is used. Defaults to None.
+
+        ram_cache : NoneType, int, optional
+                Size in bytes of parsed training data kept in memory after
+                the first pass, so that following epochs do not read or
+                parse records. Training files that do not fit are cached in
+                disk_cache, if specified. The validation set is iterated
+                anew at each evaluation, which would discard an in-memory
+                cache, so it is only cached in disk_cache. Defaults to None.
+
+        disk_cache : NoneType, str, optional
+                Directory on a local disk for caching parsed training and
+                validation data that do not fit into ram_cache. Cache files
+                depend on class_subset, pick_channels and decim and are
+                reused by later runs. A run interrupted during the first
+                pass leaves a lockfile that must be removed. Defaults to
+                None.
+
+        shuffle_size : int, optional
+                Size in bytes of the buffer used to shuffle training
+                records. The order of training files is shuffled as well,
+                with a new order on every pass over the data. If 0, the
+                training set is not shuffled. Defaults to 2**27 (128 MB).
+
+        seed : NoneType, int, optional
+                Random seed for shuffling. Shuffling still differs between
+                passes over the data. Defaults to None.
+
+        class_weights : NoneType, str, dict, optional
+                Class-balanced sampling of the training set. If 'balanced',
+                classes alternate so that each batch contains (nearly)
+                equal numbers of epochs of each class. If dict
+                {class: weight}, epochs are drawn from each class with
+                probability proportional to its weight. Records of each
+                class are read from separate streams selected with the
+                per-record labels of the shard indexes, so no records are
+                parsed and discarded. With TFRecord files, however, each
+                class stream reads every shard containing the class and
+                skips the other records, so that with K classes up to K
+                times more data are read per pass. With backend='numpy'
+                only the selected records are read. Classes are drawn with
+                replacement, i.e. rare classes are repeated within a pass.
+                If None, records are read in stored order. Defaults to
+                None.
+
+        crop : NoneType, int, optional
+                Length of the training windows in timepoints (after
+                decimation). Each training epoch is cropped at a random
+                position on every pass, validation and test epochs are
+                cropped at the center. h_params['n_t'] is set to crop.
+                Defaults to None.
+
+        jitter : int, optional
+                Maximum random shift of training epochs (or crops) in
+                timepoints. Epochs are padded with their edge values.
+                Defaults to 0.
+
+        noise : float, optional
+                Standard deviation of Gaussian noise added to training
+                epochs relative to the standard deviation of each channel
+                in the epoch. Defaults to 0.
+
+        folds : bool, optional
+                Whether to build the datasets for cross-validation over the
+                files of h_params, see mneflow.utils.leave_one_subj_out.
+                The training and validation sets then exclude the file
+                selected with set_fold and the test set self.test contains
+                only this file of h_params['orig_paths']. Files are
+                selected when the iterators are initialized with
+                self.fold_feed, so that the same graph is used for all
+                folds. Caches are not used. Defaults to False.
         """
-        self.h_params = h_params
+        self.h_params = dict(h_params)
         self.channel_subset = pick_channels
         self.class_subset = class_subset
         self.decim = decim
+        self.cycle_length = cycle_length
+        self.deterministic = deterministic
+        self.prefetch = prefetch
+        self.val_batch = val_batch or train_batch
+        self.ram_cache = ram_cache
+        self.disk_cache = disk_cache
+        self.shuffle_size = shuffle_size
+        self.seed = seed
+        self._rng = np.random.RandomState(seed)
+        #  Per-record labels of the shards, see _labels
+        self._shard_labels = {}
+        self.class_weights = class_weights
+        #  Number of stored timepoints, h_params['n_t'] is the number of
+        #  timepoints after decimation
+        self.n_t = int(h_params['n_t'])
+        if not self.decim is None:
+            self.timepoints = np.arange(0, self.n_t, self.decim)
+            self.h_params['n_t'] = len(self.timepoints)
+        #  Number of parsed timepoints, before cropping
+        self._parsed_n_t = self.h_params['n_t']
+        self.crop = crop
+        self.jitter = jitter
+        self.noise = noise
+        if crop:
+            if crop > self._parsed_n_t:
+                raise ValueError('crop ({}) exceeds the number of timepoints '
+                                 '({})'.format(crop, self._parsed_n_t))
+            self.h_params['n_t'] = crop
+        #  RAM cache budget, used by the training set only
+        self._ram_left = ram_cache or 0
+        #  Position of the held out file, fed when iterators are initialized
+        self.fold_feed = {}
+        self.holdout = None
+        holdout = None
+        if folds:
+            self.holdout = tf.placeholder_with_default(
+                tf.constant(-1, tf.int64), shape=[], name='holdout')
+            holdout = 'exclude'
         self.train = self._build_dataset(self.h_params['train_paths'],
-                                        n_batch=train_batch)
+                                         n_batch=train_batch, split='train',
+                                         cache=True, shuffle=True,
+                                         balance=bool(class_weights),
+                                         augment=True, holdout=holdout)
         self.val = self._build_dataset(self.h_params['val_paths'],
-                                      n_batch=None)
-        if isinstance(self.decim, int):
-            self.h_params['n_t'] /= self.decim
+                                       n_batch=self.val_batch, split='val',
+                                       repeat=False, cache=True,
+                                       holdout=holdout)
+        if folds:
+            self.test = self._build_dataset(self.h_params['orig_paths'],
+                                            n_batch=self.val_batch,
+                                            repeat=False, holdout='only')
 
-    def _build_dataset(self, path, n_batch=None):
+    def set_fold(self, fold):
+        """
+        Select the held out file of a cross-validation fold
+
+        Takes effect when the iterators of the datasets are initialized
+        with self.fold_feed. Requires folds=True.
+
+        Parameters
+        ----------
+        fold : int
+                position of the held out file in h_params['train_paths'],
+                h_params['val_paths'] and h_params['orig_paths'].
+        """
+        if self.holdout is None:
+            raise ValueError('Dataset was initialized with folds=False')
+        self.fold_feed = {self.holdout: fold}
+
+    def _build_dataset(self, path, n_batch=None, split=None, repeat=True,
+                       cache=False, shuffle=False, balance=False,
+                       augment=False, holdout=None):
         """
         Produce a tf.Dataset object and apply preprocessing functions
         if specified.
+
+        n_batch : NoneType, int
+            Batch size. If None, all records form a single batch.
+
+        split : NoneType, str {'train', 'val'}
+            If the data were produced with layout='index', only the records
+            of this split are used. If None, all records in path are used.
+
+        repeat : bool
+            If False, the dataset ends after one pass over the records.
+
+        cache : bool
+            Whether to use the RAM and disk caches, see ram_cache and
+            disk_cache. The RAM cache is only used if repeat is True, as
+            it is discarded whenever the iterator is re-initialized.
+
+        shuffle : bool
+            Whether to shuffle files and records, see shuffle_size.
+
+        balance : bool
+            Whether to sample classes according to class_weights. The
+            resulting dataset is infinite and is not cached.
+
+        augment : bool
+            Whether to apply random crops, jitter and noise. If False,
+            epochs are cropped at the center if crop is specified.
+
+        holdout : NoneType, str {'exclude', 'only'}
+            If 'exclude', the file at position self.holdout in path is not
+            read, if 'only', only this file is read, see folds. Caches are
+            not used.
         """
-        dataset = tf.data.TFRecordDataset(path)
-        dataset = dataset.map(self._parse_function)
-        if not self.channel_subset is None:
-            dataset = dataset.map(self._select_channels)
-        if not self.class_subset is None:
-            dataset = dataset.filter(self._select_classes)
-        if not self.decim is None:
-            print('decimating')
-            self.timepoints = tf.constant(np.arange(0, self.h_params['n_t'], self.decim))
-            dataset = dataset.map(self._decimate)
-        if n_batch:
-            dataset = dataset.batch(n_batch).repeat()
+        if self.h_params.get('layout') != 'index':
+            split = None
+        if isinstance(path, str):
+            path = [path]
+        if not n_batch:
+            n_batch = self._get_n_samples(path, split)
+        shuffle = shuffle and bool(self.shuffle_size)
+        if balance:
+            dataset = self._balanced_batches(path, n_batch, split, shuffle,
+                                             holdout)
+        elif cache and not holdout and (self.ram_cache or self.disk_cache):
+            dataset = self._cached_batches(path, n_batch, split, ram=repeat)
+            if shuffle:
+                #  Cached batches are the same on every pass, records are
+                #  shuffled after the cache
+                buffer_size = self._shuffle_records(path, n_batch,
+                                                    self._record_size())
+                dataset = dataset.apply(tf.data.experimental.unbatch())
+                dataset = dataset.shuffle(buffer_size, seed=self.seed)
+                dataset = dataset.batch(n_batch)
         else:
-            ds_size = self._get_n_samples(path)
-            dataset = dataset.batch(ds_size).repeat()
+            dataset = self._read_batches(path, n_batch, split, shuffle,
+                                         holdout)
+        if augment and (self.crop or self.jitter or self.noise):
+            dataset = dataset.map(self._augment,
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        elif self.crop:
+            dataset = dataset.map(self._center_crop)
+        if repeat:
+            dataset = dataset.repeat()
         dataset = dataset.map(self._unpack)
+        return dataset.prefetch(self.prefetch)
+
+    def profile(self, path=None, split='train', n_batch=None, n_batches=20,
+                step_time=0.):
+        """
+        Measure the throughput of the input pipeline stage by stage
+
+        Pipelines ending after each stage are drained without a model:
+        'read' (reading and selecting serialized records), 'parse' (parsing
+        and decoding), 'select' (channel selection, decimation and
+        conversion to float32) and 'augment' (if crop, jitter or noise are
+        specified). With backend='numpy' reading, selection and conversion
+        form a single 'read' stage. The stage adding the most time per
+        record is reported as the bottleneck.
+
+        Occupancy of the prefetch buffer is estimated by draining each
+        stage again through a buffer of self.prefetch batches, consumed by
+        a loop taking step_time seconds per batch (e.g. the training step
+        time, see Model.profile). The mean time blocked on get_next and the
+        share of batches for which the buffer was empty (blocked for more
+        than 1 ms) are reported. A stage that keeps the buffer filled
+        blocks close to 0 ms.
+
+        Parameters
+        ----------
+        path : NoneType, str, list of str
+                files to read. If None, the training set is used.
+
+        split : NoneType, str {'train', 'val'}
+                split of the records in path, see _build_dataset.
+
+        n_batch : NoneType, int
+                batch size. If None, val_batch is used.
+
+        n_batches : int
+                number of batches drained in each stage.
+
+        step_time : float
+                time in seconds the consumer of the prefetch buffer takes
+                per batch.
+
+        Returns
+        --------
+        stats : list of dict
+                {'stage', 'records_per_s', 'mb_per_s', 'wait_ms', 'empty'}
+                for each stage. mb_per_s is the throughput in MB of stored
+                records, wait_ms the mean time blocked on the prefetch
+                buffer per batch and empty the share of batches for which
+                the buffer was empty.
+        """
+        if path is None:
+            path = self.h_params['train_paths']
+        if isinstance(path, str):
+            path = [path]
+        if self.h_params.get('layout') != 'index':
+            split = None
+        n_batch = n_batch or self.val_batch
+        info = [self._shard_info(fname) for fname in path]
+        record_size = (sum(shard['n_bytes'] for shard in info)
+                       / max(sum(shard['n_records'] for shard in info), 1))
+        stats = []
+        with tf.Session() as sess:
+            for stage, dataset in self._profile_stages(path, n_batch, split):
+                n_records, elapsed, _ = _drain(sess, dataset, n_batches)
+                _, _, waits = _drain(sess, dataset.prefetch(self.prefetch),
+                                     n_batches, step_time=step_time)
+                stats.append(dict(stage=stage,
+                                  records_per_s=n_records / elapsed,
+                                  mb_per_s=n_records * record_size / elapsed
+                                  / 2.**20,
+                                  wait_ms=1e3 * np.mean(waits),
+                                  empty=np.mean(waits > 1e-3)))
+        print('stage       records/s        MB/s    wait ms   empty')
+        for stage in stats:
+            print('%-8s %12.0f %11.1f %10.2f %6.0f%%'
+                  % (stage['stage'], stage['records_per_s'],
+                     stage['mb_per_s'], stage['wait_ms'],
+                     100*stage['empty']))
+        #  Time per record added by each stage
+        times = [1. / stage['records_per_s'] for stage in stats]
+        added = np.diff([0.] + times)
+        print('Bottleneck: %s (%.3g ms/record)'
+              % (stats[int(np.argmax(added))]['stage'], 1e3*np.max(added)))
+        return stats
+
+    def _profile_stages(self, path, n_batch, split=None):
+        """Pipelines ending after each stage, see profile"""
+        autotune = tf.data.experimental.AUTOTUNE
+        if self.h_params.get('backend') == 'numpy':
+            dataset = self._build_numpy_dataset(path, n_batch, split)
+            stages = [('read', dataset)]
+        else:
+            records = self._read_records(path, split,
+                                         classes=self.class_subset or None)
+            records = records.batch(n_batch)
+            decode = lambda records: self._decode(
+                tf.parse_example(records, self._features())['X'])
+            dataset = records.map(self._parse_batch,
+                                  num_parallel_calls=autotune)
+            stages = [('read', records),
+                      ('parse', records.map(decode,
+                                            num_parallel_calls=autotune)),
+                      ('select', dataset)]
+        if self.crop or self.jitter or self.noise:
+            stages.append(('augment', dataset.map(self._augment,
+                                                  num_parallel_calls=autotune)))
+        return stages
+
+    def _read_batches(self, path, n_batch, split=None, shuffle=False,
+                      holdout=None):
+        """Read, parse and select batches of records from files in path"""
+        if self.h_params.get('backend') == 'numpy':
+            return self._build_numpy_dataset(path, n_batch, split, shuffle,
+                                             holdout=holdout)
+        #  Records of other classes are dropped before parsing
+        dataset = self._read_records(path, split, shuffle,
+                                     classes=self.class_subset or None,
+                                     holdout=holdout)
+        if shuffle:
+            #  Serialized records are shuffled before parsing
+            buffer_size = self._shuffle_records(path, n_batch)
+            dataset = dataset.shuffle(buffer_size, seed=self.seed)
+        #  Serialized records are batched first, so that parsing, channel
+        #  selection and decimation run once per batch
+        dataset = dataset.batch(n_batch)
+        return dataset.map(self._parse_batch,
+                           num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    def _balanced_batches(self, path, n_batch, split=None, shuffle=False,
+                          holdout=None):
+        """Read batches mixing per-class streams according to
+        self.class_weights"""
+        classes, weights = self._class_sampling(path, split)
+        if self.h_params.get('backend') == 'numpy':
+            return self._build_numpy_dataset(path, n_batch, split,
+                                             balance=(classes, weights),
+                                             holdout=holdout)
+        #  Shuffle buffer is shared between classes
+        buffer_size = self._shuffle_records(path, n_batch) // len(classes)
+        streams = []
+        for c in classes:
+            records = self._read_records(path, split, shuffle, classes=[c],
+                                         holdout=holdout)
+            if shuffle:
+                records = records.shuffle(max(1, buffer_size), seed=self.seed)
+            streams.append(records.repeat())
+        if self.class_weights == 'balanced':
+            choice = tf.data.Dataset.range(len(streams)).repeat()
+            dataset = tf.data.experimental.choose_from_datasets(streams,
+                                                                choice)
+        else:
+            dataset = tf.data.experimental.sample_from_datasets(streams,
+                                                                weights,
+                                                                seed=self.seed)
+        dataset = dataset.batch(n_batch)
+        return dataset.map(self._parse_batch,
+                           num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    def _class_sampling(self, path, split=None):
+        """Classes sampled by _balanced_batches and their probabilities
+
+        Classes without records in path, outside of self.class_subset or
+        with zero weight are not sampled.
+        """
+        if isinstance(path, str):
+            path = [path]
+        labels = np.concatenate([self._labels(fname)[self._record_mask(fname, split)]
+                                 for fname in path])
+        classes = np.unique(labels)
+        if not self.class_subset is None:
+            classes = classes[np.isin(classes, self.class_subset)]
+        if self.class_weights == 'balanced':
+            weights = np.ones(len(classes))
+        else:
+            weights = np.array([self.class_weights.get(c, 0.)
+                                for c in classes], float)
+            classes, weights = classes[weights > 0], weights[weights > 0]
+        return classes.tolist(), (weights / weights.sum()).tolist()
+
+    def _cached_batches(self, path, n_batch, split=None, ram=True):
+        """Read batches through the RAM and local disk caches
+
+        If ram is True, files are assigned to the RAM cache in order while
+        their parsed size fits into the remaining self.ram_cache budget.
+        The in-memory cache lives in the iterator and is lost when the
+        iterator is re-initialized, so ram should be False for datasets
+        that are not repeated. Batches of the other files are cached in a
+        file in self.disk_cache, which is named after the files, the split,
+        the batch size and the class, channel and timepoint selection. The
+        cache is filled during the first pass over the dataset, later passes
+        (and runs) do not parse records.
+        """
+        record_size = self._record_size()
+        ram_files, disk = [], []
+        for fname in path:
+            size = record_size * self._get_n_samples(fname, split)
+            if ram and size <= self._ram_left:
+                ram_files.append(fname)
+                self._ram_left -= size
+            else:
+                disk.append(fname)
+        tiers = []
+        if ram_files:
+            tiers.append(self._read_batches(ram_files, n_batch,
+                                            split).cache())
+        if disk:
+            dataset = self._read_batches(disk, n_batch, split)
+            if self.disk_cache:
+                if not os.path.exists(self.disk_cache):
+                    os.makedirs(self.disk_cache)
+                fname = os.path.join(self.disk_cache,
+                                     self._cache_key(disk, n_batch, split))
+                dataset = dataset.cache(fname)
+            tiers.append(dataset)
+        dataset = tiers[0]
+        for tier in tiers[1:]:
+            dataset = dataset.concatenate(tier)
         return dataset
 
-    def _select_channels(self, example_proto):
+    def _record_size(self):
+        """Size of a parsed record, float32 data and int64/float32 label"""
+        n_ch = (self.h_params['n_ch'] if self.channel_subset is None
+                else len(self.channel_subset))
+        return 4 * n_ch * self._parsed_n_t + 8
+
+    def _shuffle_records(self, path, n_batch, record_size=None):
+        """Number of records in the shuffle buffer
+
+        The buffer holds at most self.shuffle_size bytes of records of the
+        size record_size, by default the average size of the stored records
+        in the shard indexes, and at least n_batch records.
+        """
+        if isinstance(path, str):
+            path = [path]
+        info = [self._shard_info(fname) for fname in path]
+        n_records = sum(shard['n_records'] for shard in info)
+        if record_size is None:
+            n_bytes = sum(shard['n_bytes'] for shard in info)
+            record_size = n_bytes / max(n_records, 1)
+        buffer_size = max(n_batch, self.shuffle_size // max(record_size, 1))
+        return int(max(1, min(n_records, buffer_size)))
+
+    def _cache_key(self, path, n_batch, split=None):
+        """Name of the disk cache of a dataset"""
+        picks = self.channel_subset
+        if picks is not None:
+            picks = np.asarray(picks).tolist()
+        key = dict(path=[(fname, os.path.getmtime(fname)) for fname in path],
+                   n_batch=n_batch, split=split, class_subset=self.class_subset,
+                   pick_channels=picks, decim=self.decim,
+                   dtype=self.h_params.get('dtype'),
+                   quantization=self.h_params.get('quantization'))
+        return 'mneflow_' + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def _build_numpy_dataset(self, path, n_batch, split=None, shuffle=False,
+                             balance=None, holdout=None):
+        """
+        Produce a tf.Dataset of batches read from memory-mapped .npy files
+
+        Channel selection and decimation are applied to the memory map, so
+        that only the selected data are read from disk. balance is a tuple
+        (classes, weights), see _numpy_balanced_batches. The held out file
+        (see _build_dataset) is passed to the generator on initialization.
+        """
+        if isinstance(path, str):
+            path = [path]
+        X, y = self._memmap(path[0])
+        dtype = _DTYPES[self.h_params.get('dtype', 'float32')][1]
+        if self.h_params['task'] == 'classification':
+            types = {'X': dtype, 'y': tf.int64}
+        else:
+            types = {'X': dtype, 'y': tf.float32}
+        if self.channel_subset is None:
+            shape = (None,) + X.shape[1:]
+        else:
+            shape = (None, len(self.channel_subset), X.shape[-1])
+        shapes = {'X': tf.TensorShape(shape),
+                  'y': tf.TensorShape((None,) + y.shape[1:])}
+
+        def batches(fold=-1):
+            files = path
+            if holdout == 'exclude':
+                files = [fn for i, fn in enumerate(path) if i != fold]
+            elif holdout == 'only':
+                files = [fn for i, fn in enumerate(path) if i == fold]
+            if balance:
+                return self._numpy_balanced_batches(files, n_batch, split,
+                                                    *balance)
+            return self._numpy_batches(files, n_batch, split, shuffle)
+
+        args = (self.holdout,) if holdout else None
+        dataset = tf.data.Dataset.from_generator(batches, types, shapes,
+                                                 args=args)
+        return dataset.map(self._dequantize_sample)
+
+    def _memmap(self, path):
+        """Memory-map data and labels of a .npy shard
+
+        Returns views of the data with self.decim and (contiguous)
+        self.channel_subset applied. Views are not copied until a batch is
+        produced.
+        """
+        X = np.load(path, mmap_mode='r')
+        y = np.load(_labels_path(path), mmap_mode='r')
+        if not self.decim is None:
+            X = X[..., ::self.decim]
+        if self._contiguous_channels():
+            X = X[:, self.channel_subset[0]:self.channel_subset[-1]+1]
+        return X, y
+
+    def _contiguous_channels(self):
+        """Whether self.channel_subset can be applied as a slice"""
+        if self.channel_subset is None or not len(self.channel_subset):
+            return False
+        return np.all(np.diff(self.channel_subset) == 1)
+
+    def _numpy_batches(self, path, n_batch, split=None, shuffle=False):
+        """Generate batches of n_batch epochs from .npy shards in path
+
+        If shuffle is True, files and windows of consecutive records are
+        read in random order and records are shuffled within each window.
+        Window size is given by _shuffle_records.
+        """
+        window = n_batch
+        if shuffle:
+            window = self._shuffle_records(path, n_batch)
+            path = [path[i] for i in self._rng.permutation(len(path))]
+        X_batch, y_batch, n = [], [], 0
+        for fn in path:
+            for X_, y_ in self._numpy_windows(fn, window, split, shuffle):
+                while len(y_):
+                    X_batch.append(X_[:n_batch - n])
+                    y_batch.append(y_[:n_batch - n])
+                    X_, y_ = X_[n_batch - n:], y_[n_batch - n:]
+                    n += len(y_batch[-1])
+                    if n == n_batch:
+                        yield {'X': np.concatenate(X_batch),
+                               'y': np.concatenate(y_batch)}
+                        X_batch, y_batch, n = [], [], 0
+        if n:
+            yield {'X': np.concatenate(X_batch),
+                   'y': np.concatenate(y_batch)}
+
+    def _numpy_balanced_batches(self, path, n_batch, split, classes, weights):
+        """Generate an infinite sequence of class-balanced batches
+
+        Records of each class are drawn without replacement in random order,
+        starting a new permutation once all records of the class are used.
+        Per batch, classes alternate if self.class_weights is 'balanced',
+        otherwise the number of records of each class is drawn from a
+        multinomial distribution with probabilities weights.
+        """
+        picks = None
+        if not (self.channel_subset is None or self._contiguous_channels()):
+            picks = np.asarray(self.channel_subset)
+        maps = [self._memmap(fn) for fn in path]
+        #  (file, record) pairs of each class
+        index = []
+        for c in classes:
+            index.append(np.concatenate([
+                np.stack([np.full(mask.sum(), i), np.where(mask)[0]], 1)
+                for i, mask in enumerate(self._record_mask(fn, split, [c])
+                                         for fn in path)]))
+        pos = [len(ind) for ind in index]
+        first = 0
+        while True:
+            if self.class_weights == 'balanced':
+                counts = np.bincount((first + np.arange(n_batch)) % len(classes),
+                                     minlength=len(classes))
+                first += n_batch
+            else:
+                counts = self._rng.multinomial(n_batch, weights)
+            batch = []
+            for ci, n in enumerate(counts):
+                while n:
+                    if pos[ci] == len(index[ci]):
+                        index[ci] = self._rng.permutation(index[ci])
+                        pos[ci] = 0
+                    taken = index[ci][pos[ci]:pos[ci] + n]
+                    pos[ci] += len(taken)
+                    n -= len(taken)
+                    batch.append(taken)
+            batch = np.concatenate(batch)
+            X_batch, y_batch = [], []
+            for i in np.unique(batch[:, 0]):
+                #  Sorted reads from each memory map
+                records = np.sort(batch[batch[:, 0] == i, 1])
+                X, y = maps[i]
+                X_ = X[records]
+                if not picks is None:
+                    X_ = X_[:, picks]
+                X_batch.append(X_)
+                y_batch.append(y[records])
+            yield {'X': np.concatenate(X_batch), 'y': np.concatenate(y_batch)}
+
+    def _numpy_windows(self, path, window, split=None, shuffle=False):
+        """Generate selected records of a .npy shard by windows of
+        consecutive records"""
+        picks = None
+        if not (self.channel_subset is None or self._contiguous_channels()):
+            picks = np.asarray(self.channel_subset)
+        X, y = self._memmap(path)
+        classes = self.class_subset or None
+        mask = None
+        if split or not classes is None:
+            mask = self._record_mask(path, split, classes)
+        starts = np.arange(0, len(y), window)
+        if shuffle:
+            starts = self._rng.permutation(starts)
+        for start in starts:
+            X_, y_ = X[start:start+window], y[start:start+window]
+            if mask is None:
+                keep = np.ones(len(y_), bool)
+            else:
+                keep = mask[start:start+window]
+            if shuffle:
+                ind = self._rng.permutation(np.where(keep)[0])
+                X_, y_ = X_[ind], y_[ind]
+            elif not keep.all():
+                X_, y_ = X_[keep], y_[keep]
+            if not picks is None:
+                X_ = X_[:, picks]
+            yield X_, y_
+
+    def _select_channels(self, X):
         """Pick a subset of channels specified by self.channel_subset"""
-        example_proto['X'] = tf.gather(example_proto['X'],
-                                       tf.constant(self.channel_subset),
-                                       axis=0)
-        return example_proto
+        return tf.gather(X, tf.constant(self.channel_subset), axis=-2)
 
 #    def global_scale(self,example_proto):
 #        example_proto['X'] -= tf.reduce_mean(example_proto['X'],axis = -1,
 #        return example_proto
 
-    def _decimate(self, example_proto):
+    def _decimate(self, X):
         """Downsample data"""
-        print(example_proto['X'].shape)
-        example_proto['X'] = tf.gather(example_proto['X'],
-                                       self.timepoints,
-                                       axis=-1)
-        print(example_proto['X'].shape)
-        return example_proto
-
-    def _get_n_samples(self, path):
+        return tf.gather(X, tf.constant(self.timepoints), axis=-1)
+
+    def _get_n_samples(self, path, split=None):
         """Count number of samples in TFRecord files specified by path"""
-        ns = 0
-        if isinstance(path, (list, tuple)):
-            for fn in path:
-                for record in tf.python_io.tf_record_iterator(fn):
-                    ns += 1
-        elif isinstance(path, str):
-            for record in tf.python_io.tf_record_iterator(path):
-                ns += 1
-        return ns
+        if isinstance(path, str):
+            path = [path]
+        classes = self.class_subset or None
+        if split or not classes is None:
+            return int(sum(self._record_mask(fn, split, classes).sum()
+                           for fn in path))
+        return sum(self._shard_info(fn)['n_records'] for fn in path)
 
-    def _parse_function(self, example_proto):
-        """Restore data shape from serialized records"""
+    def _record_mask(self, path, split=None, classes=None):
+        """Boolean mask of the records of a shard belonging to split and
+        to one of classes
+
+        Class labels of the records are stored in the shard index at ingest
+        time, so records can be selected without reading them.
+        """
+        if split:
+            mask = self._split_mask(path, split)
+        else:
+            mask = np.ones(self._shard_info(path)['n_records'], bool)
+        if not classes is None:
+            mask &= np.isin(self._labels(path), classes)
+        return mask
+
+    def _labels(self, path):
+        """Class label of each record of a shard, from the shard index
+
+        Labels are loaded once per shard (see _shard_info).
+        """
+        if path not in self._shard_labels:
+            self._index_shard(path)
+        return self._shard_labels[path]
+
+    def _index_shard(self, path):
+        """Load the index of a shard into the shard info and labels
+        caches"""
+        stats, labels = _load_index(path, self.h_params.get('compression'))
+        self.h_params.setdefault('shards', {}).setdefault(path, stats)
+        self._shard_labels[path] = labels
+
+    def _split_mask(self, path, split):
+        """Boolean mask of the records of a shard belonging to split"""
+        mask = np.zeros(self._shard_info(path)['n_records'], bool)
+        mask[_load_split(path)[split]] = True
+        return mask
+
+    def _read_records(self, path, split=None, shuffle=False, classes=None,
+                      holdout=None):
+        """Read serialized records from TFRecord files in path
+
+        Reads from self.cycle_length files are interleaved. If split or
+        classes are specified, other records are dropped before parsing and
+        files without selected records are not read. If shuffle is True,
+        files are read in random order. holdout selects files by their
+        position in path, see _build_dataset. If no record is selected, the
+        dataset is empty.
+        """
+        if isinstance(path, str):
+            path = [path]
+        compression = self.h_params.get('compression', '')
+        select = bool(split) or not classes is None
+        index = np.arange(len(path), dtype=np.int64)
+        if select:
+            masks = [self._record_mask(fn, split, classes) for fn in path]
+            index = np.array([i for i, m in enumerate(masks) if m.any()],
+                             np.int64)
+            path = [fn for fn, m in zip(path, masks) if m.any()]
+            masks = [m for m in masks if m.any()]
+            if not path:
+                #  No selected records, e.g. validation split of size 0
+                return tf.data.Dataset.from_tensor_slices(
+                    tf.constant([], tf.string))
+            counts = np.array([len(m) for m in masks], np.int64)
+            mask = np.concatenate(masks)
+        else:
+            counts = np.zeros(len(path), np.int64)
+        offsets = np.cumsum(counts) - counts
+
+        def read_file(fname, offset, count):
+            records = tf.data.TFRecordDataset(fname,
+                                              compression_type=compression,
+                                              buffer_size=_READ_BUFFER)
+            if not select:
+                return records
+            #  Position of each record in the mask of all files
+            keep = tf.data.Dataset.range(offset, offset + count)
+            keep = keep.map(lambda i: tf.gather(tf.constant(mask), i))
+            records = tf.data.Dataset.zip((records, keep))
+            records = records.filter(lambda record, selected: selected)
+            return records.map(lambda record, selected: record)
+
+        files = tf.data.Dataset.from_tensor_slices((path, offsets, counts,
+                                                    index))
+        if holdout:
+            keep = tf.not_equal if holdout == 'exclude' else tf.equal
+            files = files.filter(lambda fname, offset, count, i:
+                                 keep(i, self.holdout))
+        files = files.map(lambda fname, offset, count, i:
+                          (fname, offset, count))
+        if shuffle:
+            files = files.shuffle(len(path), seed=self.seed)
+        cycle_length = max(1, min(self.cycle_length, len(path)))
+        return files.apply(tf.data.experimental.parallel_interleave(
+            read_file, cycle_length=cycle_length,
+            sloppy=not self.deterministic,
+            prefetch_input_elements=cycle_length))
+
+    def _shard_info(self, path):
+        """Number of records, size and class counts of a TFRecord shard
+
+        Uses the shard index stored in metadata by produce_tfrecords. Shards
+        without an index are scanned once and the index is cached next to
+        the shard file, if it can be written.
+        """
+        shards = self.h_params.setdefault('shards', {})
+        if path not in shards:
+            self._index_shard(path)
+        return shards[path]
+
+    def _features(self):
+        """Features of the serialized records"""
+        if self.h_params.get('schema_version', 1) >= 2:
+            #  X is stored as raw bytes of the storage dtype
+            x_feature = tf.FixedLenFeature((), tf.string)
+        else:
+            x_feature = tf.FixedLenFeature((self.h_params['n_ch'], self.n_t),
+                                           tf.float32)
         if self.h_params['task'] == 'classification':
-            keys_to_features = {'X': tf.FixedLenFeature((self.h_params['n_ch'],
-                                                        self.h_params['n_t']),
-                                                        tf.float32),
-                                'y': tf.FixedLenFeature((),
-                                                        tf.int64,
-                                                        default_value=0)}
+            return {'X': x_feature,
+                    'y': tf.FixedLenFeature((), tf.int64, default_value=0)}
         else:
-            keys_to_features = {'X': tf.FixedLenFeature((self.h_params['n_ch'],
-                                                         self.h_params['n_t']),
-                                                        tf.float32),
-                                'y': tf.FixedLenFeature(self.h_params['y_shape'],
-                                                        tf.float32)}
+            return {'X': x_feature,
+                    'y': tf.FixedLenFeature(self.h_params['y_shape'],
+                                            tf.float32)}
+
+    def _decode(self, X):
+        """Restore data shape, shape (..., n_channels, n_timepoints)"""
+        if self.h_params.get('schema_version', 1) < 2:
+            return X
+        dtype = _DTYPES[self.h_params.get('dtype', 'float32')][1]
+        X = tf.decode_raw(X, dtype, little_endian=True)
+        shape = [self.h_params['n_ch'], self.n_t]
+        if X.shape.ndims > 1:
+            shape = [-1] + shape
+        return tf.reshape(X, shape)
+
+    def _parse_function(self, example_proto):
+        """Restore data shape from a serialized record"""
         parsed_features = tf.parse_single_example(example_proto,
-                                                  keys_to_features)
+                                                  self._features())
+        parsed_features['X'] = self._dequantize(self._decode(parsed_features['X']))
         return parsed_features
 
-    def _select_classes(self, sample):
-        """Picks a subset of classes specified in self.class_subset"""
-        if self.class_subset:
-            subset = tf.constant(self.class_subset, dtype=tf.int64)
-            out = tf.reduce_any(tf.equal(sample['y'], subset))
-            return out
-        else:
-            return tf.constant(True, dtype=tf.bool)
+    def _parse_batch(self, records):
+        """Parse a batch of serialized records
+
+        Channel selection and decimation are applied to the whole batch
+        before conversion to float32.
+        """
+        parsed_features = tf.parse_example(records, self._features())
+        X = self._decode(parsed_features['X'])
+        if not self.channel_subset is None:
+            X = self._select_channels(X)
+        if not self.decim is None:
+            X = self._decimate(X)
+        parsed_features['X'] = self._dequantize(X, self.channel_subset)
+        return parsed_features
+
+    def _dequantize(self, X, channels=None):
+        """Convert data from the storage dtype to float32
+
+        Parameters
+        ----------
+        X : tf.Tensor, shape (..., n_channels, n_timepoints)
+
+        channels : NoneType, ndarray of int
+            indices of the channels in X, if a subset is picked.
+        """
+        X = tf.cast(X, tf.float32)
+        quantization = self.h_params.get('quantization')
+        if self.h_params.get('dtype') == 'int16' and quantization:
+            scale = np.asarray(quantization['scale'], np.float32)
+            offset = np.asarray(quantization['offset'], np.float32)
+            if channels is not None:
+                scale, offset = scale[channels], offset[channels]
+            X = X * scale[:, None] + offset[:, None]
+        return X
+
+    def _dequantize_sample(self, sample):
+        """Convert a batch of the numpy backend to float32"""
+        sample['X'] = self._dequantize(sample['X'], self.channel_subset)
+        return sample
+
+    def _augment(self, sample):
+        """Random crops, time jitter and noise applied to a batch
+
+        Cropping and jitter of all epochs in the batch are done by a single
+        gather of per-epoch timepoint indices.
+        """
+        X = sample['X']
+        if self.crop or self.jitter:
+            n_epochs = tf.shape(X)[0]
+            n_t = self._parsed_n_t
+            length = self.crop or n_t
+            if self.crop:
+                start = tf.random_uniform([n_epochs, 1], 0, n_t - length + 1,
+                                          dtype=tf.int32)
+            else:
+                start = tf.zeros([n_epochs, 1], dtype=tf.int32)
+            if self.jitter:
+                start += tf.random_uniform([n_epochs, 1], -self.jitter,
+                                           self.jitter + 1, dtype=tf.int32)
+            times = tf.clip_by_value(start + tf.range(length)[None, :], 0,
+                                     n_t - 1)
+            epochs = tf.tile(tf.range(n_epochs)[:, None], [1, length])
+            #  Gather (epoch, timepoint) pairs, shape (n_epochs, length, n_ch)
+            X = tf.gather_nd(tf.transpose(X, [0, 2, 1]),
+                             tf.stack([epochs, times], axis=-1))
+            X = tf.transpose(X, [0, 2, 1])
+        if self.noise:
+            _, var = tf.nn.moments(X, axes=[-1], keep_dims=True)
+            X += self.noise * tf.sqrt(var) * tf.random_normal(tf.shape(X))
+        sample['X'] = X
+        return sample
+
+    def _center_crop(self, sample):
+        """Crop a batch of epochs to self.crop timepoints at the center"""
+        start = (self._parsed_n_t - self.crop) // 2
+        sample['X'] = sample['X'][..., start:start + self.crop]
+        return sample
 
     def _unpack(self, sample):
         return sample['X'], sample['y']
+
+
+def _drain(sess, dataset, n_batches, step_time=0.):
+    """Time reading n_batches batches of a dataset
+
+    The first batch is read before timing starts. If step_time is given,
+    the loop sleeps for step_time seconds after each batch, like a model
+    consuming the batches.
+
+    Returns
+    -------
+    n_records : int
+        number of records in the timed batches.
+
+    elapsed : float
+        time in seconds.
+
+    waits : ndarray
+        time in seconds blocked on each batch.
+    """
+    dataset = dataset.map(lambda batch: tf.shape(batch['X'] if isinstance(batch, dict)
+                                                 else batch)[0])
+    size = dataset.repeat().make_one_shot_iterator().get_next()
+    sess.run(size)
+    n_records = 0
+    waits = np.zeros(n_batches)
+    t0 = time.time()
+    for i in range(n_batches):
+        t1 = time.time()
+        n_records += sess.run(size)
+        waits[i] = time.time() - t1
+        if step_time:
+            time.sleep(step_time)
+    return n_records, time.time() - t0, waits
+
+
+def _record_options(compression=None):
+    """TFRecordOptions for a compression codec
+
+    Parameters
+    ----------
+    compression : NoneType, str {'', 'GZIP', 'ZLIB'}
+        Compression codec, as stored in meta['compression'].
+    """
+    codecs = {'': tf.python_io.TFRecordCompressionType.NONE,
+              'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+              'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB}
+    return tf.python_io.TFRecordOptions(codecs[(compression or '').upper()])
+
+
+def _index_path(path):
+    """Path of the index file of a shard"""
+    return path + '.index.npz'
+
+
+def _split_path(path):
+    """Path of the split manifest of a shard produced with layout='index'"""
+    return path + '.split.npz'
+
+
+def _save_split(path, train, val):
+    """Save the split manifest of a shard produced with layout='index'
+
+    Parameters
+    ----------
+    path : str
+        path to the shard.
+
+    train, val : array_like of int
+        positions of the training and validation records in the shard.
+    """
+    np.savez(_split_path(path), train=np.asarray(train, np.int64),
+             val=np.asarray(val, np.int64))
+
+
+def _load_split(path):
+    """Load the split manifest of a shard, see _save_split"""
+    with np.load(_split_path(path)) as split:
+        return {key: split[key] for key in split.files}
+
+
+def _labels_path(path):
+    """Path of the labels file of a .npy shard"""
+    return path[:-len('.npy')] + '_labels.npy'
+
+
+def _index_stats(n_records, n_bytes, labels):
+    """Summarize per-record labels of a shard for storing in metadata"""
+    classes, counts = np.unique(labels, return_counts=True)
+    return dict(n_records=int(n_records), n_bytes=int(n_bytes),
+                class_counts={int(c): int(n) for c, n in zip(classes,
+                                                             counts)})
+
+
+def _save_index(path, n_records, n_bytes, labels=()):
+    """Save the index of a shard next to it
+
+    Parameters
+    ----------
+    path : str
+        path to the shard.
+
+    n_records : int
+        number of records in the shard.
+
+    n_bytes : int
+        size of the shard in bytes.
+
+    labels : array_like of int
+        class label of each record in the order of records. Empty if the
+        dataset has no class labels.
+
+    Returns
+    -------
+    stats : dict
+        {'n_records', 'n_bytes', 'class_counts'}
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    try:
+        np.savez(_index_path(path), n_records=n_records, n_bytes=n_bytes,
+                 labels=labels)
+    except (IOError, OSError):
+        print('Could not save index of', path)
+    return _index_stats(n_records, n_bytes, labels)
+
+
+def _load_index(path, compression=None):
+    """Load the index of a shard, index the shard if necessary
+
+    The index is rebuilt if it is missing or older than the shard.
+    compression specifies the codec of the shard, see _record_options.
+
+    Returns
+    -------
+    stats : dict
+        {'n_records', 'n_bytes', 'class_counts'}
+
+    labels : ndarray of int
+        class label of each record, empty if the dataset has no class
+        labels.
+    """
+    fname = _index_path(path)
+    if (os.path.exists(fname)
+            and os.path.getmtime(fname) >= os.path.getmtime(path)):
+        with np.load(fname) as index:
+            labels = index['labels']
+            return (_index_stats(index['n_records'], index['n_bytes'],
+                                 labels), labels)
+    print('Indexing', path)
+    if path.endswith('.npy'):
+        labels = np.load(_labels_path(path))
+        if not np.issubdtype(labels.dtype, np.integer):
+            labels = []
+        labels = np.asarray(labels, dtype=np.int64)
+        return (_save_index(path, np.load(path, mmap_mode='r').shape[0],
+                            os.path.getsize(path), labels), labels)
+    n_records = 0
+    labels = []
+    for record in tf.python_io.tf_record_iterator(path,
+                                                  _record_options(compression)):
+        n_records += 1
+        y = tf.train.Example.FromString(record).features.feature['y']
+        if y.int64_list.value:
+            labels.append(y.int64_list.value[0])
+    if len(labels) != n_records:
+        labels = []
+    labels = np.asarray(labels, dtype=np.int64)
+    return (_save_index(path, n_records, os.path.getsize(path), labels),
+            labels)
@@ -5,6 +5,8 @@ subclasses. Implemented models inherit basic methods from the parent class.
 
 """
 from .layers import ConvDSV, Dense, vgg_block, LFTConv, VARConv, DeMixing
+import re
+import time
 import tensorflow as tf
 import numpy as np
 from sklearn.covariance import ledoit_wolf
@@ -19,7 +21,7 @@ class Model(object):
     set_optimizer methods.
 
     """
-    def __init__(self, Dataset, Optimizer, specs):
+    def __init__(self, Dataset, Optimizer, specs, config=None):
         """
         Parameters
         -----------
@@ -34,6 +36,10 @@ class Model(object):
                 least model_path - path for saving a trained model. See
                 subclass definitions for details.
 
+        config : NoneType, tf.ConfigProto
+                session configuration, e.g. limits on the number of
+                threads. Defaults to None.
+
         """
 
         self.specs = specs
@@ -43,7 +49,8 @@ class Model(object):
         else:
             self.y_shape = Dataset.h_params['y_shape']
         self.fs = Dataset.h_params['fs']
-        self.sess = tf.Session()
+        self.dataset = Dataset
+        self.sess = tf.Session(config=config)
         self.handle = tf.placeholder(tf.string, shape=[])
         self.train_iter, self.train_handle = self._start_iterator(Dataset.train)
         self.val_iter, self.val_handle = self._start_iterator(Dataset.val)
@@ -51,7 +58,6 @@ class Model(object):
         self.iterator = tf.data.Iterator.from_string_handle(self.handle, Dataset.train.output_types, Dataset.train.output_shapes)
         self.X, self.y_ = self.iterator.get_next()
         self.rate = tf.placeholder(tf.float32, name='rate')
-        self.dataset = Dataset
         self.optimizer = Optimizer
 
     def _start_iterator(self, Dataset):
@@ -62,9 +68,96 @@ class Model(object):
 
         ds_iterator = Dataset.make_initializable_iterator()
         handle = self.sess.run(ds_iterator.string_handle())
-        self.sess.run(ds_iterator.initializer)
+        self.sess.run(ds_iterator.initializer,
+                      feed_dict=self.dataset.fold_feed)
         return ds_iterator, handle
 
+    def set_fold(self, fold):
+        """
+        Switch the input pipelines to a cross-validation fold
+
+        The training and validation iterators are re-initialized to skip
+        the held out file, the graph is not modified. Variables are
+        re-initialized by train. Requires a Dataset with folds=True.
+
+        Parameters
+        ----------
+        fold : int
+                position of the held out file, see Dataset.set_fold.
+        """
+        self.dataset.set_fold(fold)
+        for ds_iterator in [self.train_iter, self.val_iter]:
+            self.sess.run(ds_iterator.initializer,
+                          feed_dict=self.dataset.fold_feed)
+
+    def _run_epoch(self, ds_iterator, handle, fetches=()):
+        """
+        Evaluate the model on a dataset batch by batch
+
+        The dataset is read until tf.errors.OutOfRangeError, so that memory
+        use is bounded by the batch size. Cost and performance are
+        accumulated over batches and equal those computed on the whole
+        dataset at once.
+
+        Parameters
+        ----------
+        ds_iterator : tf.data.Iterator
+                initializable iterator of a dataset that is not repeated.
+
+        handle : str
+                string handle of ds_iterator.
+
+        fetches : list of tf.Tensor
+                additional outputs (e.g. predictions) collected from each
+                batch.
+
+        Returns
+        --------
+        cost : float
+
+        performance : float
+
+        outputs : list of ndarray
+                concatenated values of fetches.
+        """
+        self.sess.run(ds_iterator.initializer,
+                      feed_dict=self.dataset.fold_feed)
+        task = self.optimizer.params['task']
+        #  Regularization penalty is added once per batch to the cost
+        penalty = self.sess.run(getattr(self.optimizer, 'penalty',
+                                        tf.constant(0.)))
+        n, cost, performance, var = 0, 0., 0., 0.
+        outputs = [[] for _ in fetches]
+        while True:
+            try:
+                res = self.sess.run([self.cost, self.accuracy, self.y_]
+                                    + list(fetches),
+                                    feed_dict={self.handle: handle,
+                                               self.rate: 1.})
+            except tf.errors.OutOfRangeError:
+                break
+            batch_cost, batch_performance, y_true = res[:3]
+            if task == 'classification':
+                #  Cost and accuracy are averages over the batch
+                cost += batch_cost * len(y_true)
+                performance += batch_performance * len(y_true)
+            else:
+                cost += batch_cost - penalty
+                var += np.sum(y_true.astype(np.float64)**2)
+            for output, value in zip(outputs, res[3:]):
+                output.append(value)
+            n += len(y_true)
+        if not n:
+            print('Dataset is empty')
+            return np.nan, np.nan, outputs
+        if task == 'classification':
+            cost, performance = cost / n, performance / n
+        else:
+            cost += penalty
+            performance = 1 - cost/var
+        outputs = [np.concatenate(output) for output in outputs]
+        return cost, performance, outputs
+
     def build(self):
 
         """
@@ -72,15 +165,101 @@ class Model(object):
 
         """
 
-        # Initialize computational graph
-        self.y_pred = self.build_graph()
-        print('y_pred:', self.y_pred.shape)
-        # Initialize optimizer
-        self.saver = tf.train.Saver(max_to_keep=1)
-        opt_handles = self.optimizer.set_optimizer(self.y_pred, self.y_)
+        #  Variables are recorded in the order of creation, so that the
+        #  graph can be traced again reusing them, see _multistep
+        self._variables = []
+        #  Names requested on creation, checked when replaying
+        self._variable_names = []
+
+        def record(next_creator, **kwargs):
+            var = next_creator(**kwargs)
+            self._variables.append(var)
+            self._variable_names.append(kwargs.get('name'))
+            return var
+
+        with tf.variable_creator_scope(record):
+            # Initialize computational graph
+            self.y_pred = self.build_graph()
+            print('y_pred:', self.y_pred.shape)
+            # Initialize optimizer
+            self.saver = tf.train.Saver(max_to_keep=1)
+            #  Only variables of this model are regularized and trained
+            self._model_variables = list(self._variables)
+            opt_handles = self.optimizer.set_optimizer(
+                self.y_pred, self.y_, variables=self._model_variables)
         self.train_step, self.accuracy, self.cost, self.p_classes = opt_handles
+        self._multistep_ops = {}
         print('Initialization complete!')
 
+    def _multistep(self, n_steps):
+        """
+        Build ops running n_steps training steps in a single session call
+
+        The computational graph and the optimizer are traced again inside a
+        tf.while_loop that reads a new batch on each iteration. Variables
+        created during build are reused in the same order, a ValueError is
+        raised if the requested names or shapes differ or if a different
+        number of variables is created. Attributes of the model and the
+        optimizer (e.g. X, y_, penalty, layer handles) assigned during the
+        second trace are reset to their previous values.
+
+        Returns
+        --------
+        train_step : tf.Operation
+
+        cost : tf.Tensor
+                cost averaged over the n_steps steps.
+
+        performance : tf.Tensor
+                performance metric averaged over the n_steps steps.
+        """
+        if n_steps in self._multistep_ops:
+            return self._multistep_ops[n_steps]
+        recorded = iter(zip(self._variable_names, self._variables))
+
+        def replay(next_creator, **kwargs):
+            name, var = next(recorded, (None, None))
+            if var is None:
+                raise ValueError('build_graph created more variables than '
+                                 'during build')
+            if (_base_name(kwargs.get('name')) != _base_name(name)
+                    or not _shape_matches(kwargs.get('initial_value'), var)):
+                raise ValueError('Variable {} does not match {} created '
+                                 'during build'.format(kwargs.get('name'),
+                                                       var.name))
+            return var
+
+        def body(step, cost, performance):
+            self.X, self.y_ = self.iterator.get_next()
+            with tf.variable_creator_scope(replay):
+                y_pred = self.build_graph()
+                opt_handles = self.optimizer.set_optimizer(
+                    y_pred, self.y_, variables=self._model_variables)
+            train_step, step_performance, step_cost, _ = opt_handles
+            with tf.control_dependencies([train_step]):
+                return (step + 1, cost + step_cost,
+                        performance + step_performance)
+
+        state = dict(self.__dict__)
+        optimizer_state = dict(self.optimizer.__dict__)
+        try:
+            _, cost, performance = tf.while_loop(lambda step, *_: step < n_steps,
+                                                 body,
+                                                 [tf.constant(0),
+                                                  tf.constant(0.),
+                                                  tf.constant(0.)],
+                                                 parallel_iterations=1)
+        finally:
+            _restore_attributes(self, state)
+            _restore_attributes(self.optimizer, optimizer_state)
+        if next(recorded, None) is not None:
+            raise ValueError('build_graph created fewer variables than '
+                             'during build')
+        cost, performance = cost / n_steps, performance / n_steps
+        ops = (tf.group(cost, performance), cost, performance)
+        self._multistep_ops[n_steps] = ops
+        return ops
+
     def build_graph(self):
 
         """
@@ -101,7 +280,8 @@ class Model(object):
         y_pred = fc_1(self.X)
         return y_pred
 
-    def train(self, n_iter, eval_step=250, min_delta=1e-6, early_stopping=3):
+    def train(self, n_iter, eval_step=250, min_delta=1e-6, early_stopping=3,
+              steps_per_run=1):
         """
         Trains a model
 
@@ -122,20 +302,31 @@ class Model(object):
         min_delta : float
                 Convergence threshold for validation cost during training.
                 Defaults to 0.
+
+        steps_per_run : int
+                Number of training steps run inside the graph by a single
+                session call, which reduces per-step overhead of small
+                models. Training cost and accuracy are then averaged over
+                these steps. Must divide eval_step. The last run is
+                shortened, so that the number of steps does not depend on
+                steps_per_run.
+                Defaults to 1.
         """
+        if eval_step % steps_per_run:
+            raise ValueError('steps_per_run ({}) must divide eval_step ({})'
+                             .format(steps_per_run, eval_step))
         self.sess.run(tf.global_variables_initializer())
         min_val_loss = np.inf
 
         patience_cnt = 0
-        for i in range(n_iter+1):
-            _, t_loss, acc = self.sess.run([self.train_step, self.cost, self.accuracy],
+        for i in range(0, n_iter+1, steps_per_run):
+            train_ops = self._train_ops(min(steps_per_run, n_iter + 1 - i))
+            _, t_loss, acc = self.sess.run(train_ops,
                                            feed_dict={self.handle: self.train_handle,
                                                       self.rate: self.specs['dropout']})
             if i % eval_step == 0:
-                self.dataset.train.shuffle(buffer_size=10000)
-                self.v_acc, v_loss = self.sess.run([self.accuracy, self.cost],
-                                                   feed_dict={self.handle: self.val_handle,
-                                                              self.rate: 1.})
+                v_loss, self.v_acc, _ = self._run_epoch(self.val_iter,
+                                                        self.val_handle)
 
                 if min_val_loss >= v_loss + min_delta:
                     min_val_loss = v_loss
@@ -157,6 +348,56 @@ class Model(object):
                 print('i %d, tr_loss %g, tr_acc %g v_loss %g, v_acc %g'
                       % (i, t_loss, acc, v_loss, self.v_acc))
 
+    def _train_ops(self, n_steps):
+        """Training step, cost and accuracy ops running n_steps steps"""
+        if n_steps > 1:
+            return self._multistep(n_steps)
+        return [self.train_step, self.cost, self.accuracy]
+
+    def profile(self, n_steps=20):
+        """
+        Compare training throughput with and without the input pipeline
+
+        Runs n_steps training steps reading from the training set and
+        n_steps steps repeating a single batch kept in memory, then profiles
+        the input pipeline stages with Dataset.profile, with the prefetch
+        buffer consumed at the model-only step time. The share of step
+        time spent waiting for input tells whether training is limited by
+        the input pipeline or by the model. Training steps update the model
+        weights, which are re-initialized by train.
+
+        Parameters
+        ----------
+        n_steps : int
+                number of timed training steps.
+
+        Returns
+        --------
+        stats : dict
+                'steps_per_s', 'model_steps_per_s', 'input_wait' and
+                'pipeline' (see Dataset.profile).
+        """
+        self.sess.run(tf.global_variables_initializer())
+
+        def steps_per_s(handle):
+            feed_dict = {self.handle: handle, self.rate: self.specs['dropout']}
+            self.sess.run(self.train_step, feed_dict=feed_dict)
+            t0 = time.time()
+            for _ in range(n_steps):
+                self.sess.run(self.train_step, feed_dict=feed_dict)
+            return n_steps / (time.time() - t0)
+
+        rate = steps_per_s(self.train_handle)
+        batch = self.dataset.train.take(1).cache().repeat()
+        _, batch_handle = self._start_iterator(batch)
+        model_rate = steps_per_s(batch_handle)
+        input_wait = max(0., 1. - rate / model_rate)
+        print('steps/s: %g, model only: %g, waiting for input: %.0f%%'
+              % (rate, model_rate, 100*input_wait))
+        pipeline = self.dataset.profile(step_time=1. / model_rate)
+        return dict(steps_per_s=rate, model_steps_per_s=model_rate,
+                    input_wait=input_wait, pipeline=pipeline)
+
     def load(self):
         """
         Loads a pretrained model
@@ -168,9 +409,7 @@ class Model(object):
         self.saver.restore(self.sess, ''.join([self.model_path,
                                               self.scope, '-',
                                               self.dataset.h_params['data_id']]))
-        self.v_acc = self.sess.run([self.accuracy],
-                                   feed_dict={self.handle: self.val_handle,
-                                              self.rate: 1.})
+        _, self.v_acc, _ = self._run_epoch(self.val_iter, self.val_handle)
 
     def evaluate_performance(self, data_path, batch_size=None):
         """
@@ -182,13 +421,14 @@ class Model(object):
                     path to .tfrecords file(s).
 
         batch_size : NoneType, int
-                    whether to split the dataset into batches.
+                    number of epochs evaluated at once. Does not affect the
+                    result. If None, Dataset.val_batch is used.
         """
         test_dataset = self.dataset._build_dataset(data_path,
-                                                   n_batch=batch_size)
+                                                   n_batch=batch_size or self.dataset.val_batch,
+                                                   repeat=False)
         test_iter, test_handle = self._start_iterator(test_dataset)
-        acc = self.sess.run(self.accuracy, feed_dict={self.handle: test_handle,
-                                                      self.rate: 1.})
+        _, acc, _ = self._run_epoch(test_iter, test_handle)
         print('Finished: acc: %g +\\- %g' % (np.mean(acc), np.std(acc)))
         return np.mean(acc)
 
@@ -202,17 +442,18 @@ class Model(object):
                     path to .tfrecords file(s).
 
         batch_size : NoneType, int
-                    whether to split the dataset into batches.
+                    number of epochs evaluated at once. Does not affect the
+                    result. If None, Dataset.val_batch is used.
         """
         if data_path:
             test_dataset = self.dataset._build_dataset(data_path,
-                                                       n_batch=batch_size)
+                                                       n_batch=batch_size or self.dataset.val_batch,
+                                                       repeat=False)
             test_iter, test_handle = self._start_iterator(test_dataset)
         else:
-            test_iter, test_handle = self._start_iterator(self.dataset.val)
-        pred, true = self.sess.run([self.y_pred, self.y_],
-                                   feed_dict={self.handle: test_handle,
-                                              self.rate: 1.})
+            test_iter, test_handle = self.val_iter, self.val_handle
+        _, _, (pred, true) = self._run_epoch(test_iter, test_handle,
+                                             [self.y_pred, self.y_])
         return pred, true
 
 #    def evaluate_realtime(self, data_path, batch_size=None, step_size=1):
@@ -276,11 +517,13 @@ class Model(object):
         from sklearn.metrics import confusion_matrix
         import itertools
         if dataset == 'validation':
-            feed_dict = {self.handle: self.val_handle, self.rate: 1.}
+            _, _, (y_true, y_pred) = self._run_epoch(self.val_iter,
+                                                     self.val_handle,
+                                                     [self.y_, self.p_classes])
         elif dataset == 'training':
             feed_dict = {self.handle: self.train_handle, self.rate: 1.}
-        y_true, y_pred = self.sess.run([self.y_, self.p_classes],
-                                       feed_dict=feed_dict)
+            y_true, y_pred = self.sess.run([self.y_, self.p_classes],
+                                           feed_dict=feed_dict)
         y_pred = np.argmax(y_pred, 1)
         f = plt.figure()
         cm = confusion_matrix(y_true, y_pred)
@@ -309,6 +552,35 @@ class Model(object):
         return f
 
 
+def _base_name(name):
+    """Variable name without the suffixes added to make names unique"""
+    if name is None:
+        return None
+    return re.sub(r'_\d+(?=/|$)', '', name)
+
+
+def _shape_matches(initial_value, var):
+    """Whether a known shape of initial_value equals the shape of var"""
+    shape = getattr(initial_value, 'shape', None)
+    if shape is None or not tf.TensorShape(shape).is_fully_defined():
+        return True
+    return tf.TensorShape(shape) == var.shape
+
+
+def _restore_attributes(obj, state):
+    """Reset attributes of obj that differ from state = dict(obj.__dict__)
+
+    Attributes added since state was taken are removed, other attributes
+    are left untouched.
+    """
+    for key in list(obj.__dict__):
+        if key not in state:
+            delattr(obj, key)
+    for key, val in state.items():
+        if obj.__dict__.get(key, state) is not val:
+            setattr(obj, key, val)
+
+
 class VGG19(Model):
     """
     VGG-19 model.
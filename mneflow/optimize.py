@@ -33,7 +33,7 @@ class Optimizer(object):
         # TODO : regularization options,
         # TODO : performance metric options
 
-    def set_optimizer(self, y_pred, y_true):
+    def set_optimizer(self, y_pred, y_true, variables=None):
 
         """
         Initializes the optimizer part of the computational graph
@@ -49,6 +49,13 @@ class Optimizer(object):
         y_true : tf.Tensor
                         target_variable, output of dataset.iterator
 
+        variables : NoneType, list of tf.Variable
+                        variables of the model. Their 'weights' are
+                        regularized and trainable ones are updated, so that
+                        variables of other models in the same graph are not
+                        affected. If None, all trainable variables of the
+                        graph are used.
+
         Returns
         --------
         train_step : tf.Operation
@@ -79,22 +86,28 @@ class Optimizer(object):
             performance = 1 - cost/var
             prediction = y_pred
 
+        trainable = [var.name for var in tf.trainable_variables()]
+        if variables is None:
+            variables = tf.trainable_variables()
+        var_list = [var for var in variables if var.name in trainable]
+
         #  Regularization
+        self.penalty = tf.constant(0.)
         if self.params['l1_lambda'] > 0:
             coef = self.params['l1_lambda']
-            reg = [tf.reduce_sum(tf.abs(var))
-                   for var in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+            reg = [tf.reduce_sum(tf.abs(var)) for var in variables
                    if 'weights' in var.name]
-            cost = cost + coef * tf.add_n(reg)
+            self.penalty = coef * tf.add_n(reg)
+            cost = cost + self.penalty
 
         elif self.params['l2_lambda'] > 0:
             coef = self.params['l2_lambda']
-            reg = [tf.nn.l2_loss(var) for var in
-                   tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+            reg = [tf.nn.l2_loss(var) for var in variables
                    if 'weights' in var.name]
-            cost = cost + coef * tf.add_n(reg)
+            self.penalty = coef * tf.add_n(reg)
+            cost = cost + self.penalty
 
         #  Optimizer
-        train_step = tf.train.AdamOptimizer(learning_rate=self.params['learn_rate']).minimize(cost)
+        train_step = tf.train.AdamOptimizer(learning_rate=self.params['learn_rate']).minimize(cost, var_list=var_list)
 
         return train_step, performance, cost, prediction
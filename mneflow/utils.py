@@ -3,17 +3,35 @@
 Specifies utility functions.
 """
 import os
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import tensorflow as tf
 import scipy.io as sio
 import pickle
-from operator import itemgetter
-from mneflow.data import Dataset
+import json
+import hashlib
+import zipfile
+import struct
+from mneflow.data import (Dataset, _save_index, _record_options,
+                          _labels_path, _save_split, _DTYPES)
 from mneflow.optimize import Optimizer
 
 import csv
 
-def load_meta(fname,data_id=''):
+#  Version of the TFRecord example schema written by produce_tfrecords.
+#  1 : X stored as FloatList (mneflow <= 0.1.1)
+#  2 : X stored as raw little-endian float32 bytes
+SCHEMA_VERSION = 2
+
+#  Version of the metadata format written by produce_tfrecords.
+#  0 : pickled dict, <data_id>_meta.pkl (mneflow <= 0.1.1)
+#  1 : JSON header <data_id>_meta.json and append-only per-shard records
+#      <data_id>_shards.jsonl
+META_VERSION = 1
+
+def load_meta(fname, data_id='', shards=False):
 
     """
     Loads a metadata file
@@ -23,22 +41,146 @@ def load_meta(fname,data_id=''):
     fname : str
             path to TFRecord folder
 
+    data_id : str
+            name of the dataset, out_name of produce_tfrecords.
+
+    shards : bool
+            If True, also load the per-shard records meta['shards'] and
+            meta['fingerprints']. These are not needed to initialize
+            mneflow.Dataset, which reads the index of each shard from the
+            file stored next to it. Defaults to False.
+
     Returns
     -------
     meta : dict
         metadata file
 
     """
-    with open(fname+data_id+'_meta.pkl', 'rb') as f:
-        meta = pickle.load(f)
+    header = fname + data_id + '_meta.json'
+    if not os.path.exists(header):
+        #  Metadata pickled by earlier versions
+        with open(fname+data_id+'_meta.pkl', 'rb') as f:
+            meta = pickle.load(f)
+        return meta
+    with open(header, 'r') as f:
+        meta = json.load(f, object_hook=_from_json)
+    if meta.get('meta_version', 1) > META_VERSION:
+        print('Metadata version', meta['meta_version'], 'is newer than',
+              META_VERSION, 'some fields may be ignored')
+    if shards:
+        meta['shards'], meta['fingerprints'] = {}, []
+        for entry in _read_shard_records(fname + data_id + '_shards.jsonl'):
+            #  Records of shards missing from the header were not completed
+            if entry['train_path'] in meta['train_paths']:
+                meta['shards'].update(entry['shards'])
+                meta['fingerprints'].extend(entry['fingerprints'])
     return meta
 
 
-def leave_one_subj_out(meta, optimizer_params, graph_specs, model):
+def _read_shard_records(fname):
+    """Read per-shard metadata records, skipping incomplete lines"""
+    if not os.path.exists(fname):
+        return
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line, object_hook=_from_json)
+            except ValueError:
+                print('Skipping incomplete record in', fname)
+
+
+def _save_meta(meta, savepath, out_name):
+    """Save metadata, rewriting the per-shard records
+
+    Used when a dataset is created or converted from a pickled metadata
+    file. See _append_meta for updates after each shard.
+    """
+    with open(savepath + out_name + '_shards.jsonl', 'w') as f:
+        if meta.get('shards') or meta.get('fingerprints'):
+            train_paths = meta['train_paths']
+            entry = dict(train_path=train_paths[-1] if train_paths else None,
+                         shards=meta.get('shards', {}),
+                         fingerprints=meta.get('fingerprints', []))
+            f.write(json.dumps(_to_json(entry)) + '\n')
+    _save_meta_header(meta, savepath, out_name)
+
+
+def _append_meta(meta, savepath, out_name, train_path, shards,
+                 fingerprints):
+    """Record a new output shard in the metadata files
+
+    The per-shard record is appended first and the header is replaced
+    atomically afterwards, so that an interrupted update leaves a
+    consistent dataset without the last shard.
+    """
+    entry = dict(train_path=train_path, shards=shards,
+                 fingerprints=fingerprints)
+    with open(savepath + out_name + '_shards.jsonl', 'a') as f:
+        f.write(json.dumps(_to_json(entry)) + '\n')
+    _save_meta_header(meta, savepath, out_name)
+
+
+def _save_meta_header(meta, savepath, out_name):
+    """Atomically write all metadata except the per-shard records"""
+    header = {key: val for key, val in meta.items()
+              if key not in ('shards', 'fingerprints')}
+    header['meta_version'] = META_VERSION
+    fname = savepath + out_name + '_meta.json'
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(_to_json(header), f, indent=1, sort_keys=True)
+    os.replace(fname + '.tmp', fname)
+
+
+def _to_json(obj):
+    """Convert metadata to JSON-compatible types
+
+    Tuples and dictionaries with non-string keys are tagged, so that
+    _from_json restores them.
+    """
+    if isinstance(obj, dict):
+        if all(isinstance(key, str) for key in obj):
+            return {key: _to_json(val) for key, val in obj.items()}
+        return {'__dict__': [[_to_json(key), _to_json(val)]
+                             for key, val in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_to_json(val) for val in obj]}
+    if isinstance(obj, list):
+        return [_to_json(val) for val in obj]
+    if isinstance(obj, np.ndarray):
+        return _to_json(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _from_json(obj):
+    """Restore tagged tuples and dictionaries, see _to_json"""
+    if '__tuple__' in obj:
+        return tuple(obj['__tuple__'])
+    if '__dict__' in obj:
+        return {_hashable(key): val for key, val in obj['__dict__']}
+    return obj
+
+
+def _hashable(key):
+    """Dictionary keys are never lists, restore tuples nested in keys"""
+    if isinstance(key, list):
+        return tuple(_hashable(k) for k in key)
+    return key
+
+
+def leave_one_subj_out(meta, optimizer_params, graph_specs, model,
+                       dataset_params=None, train_params=None, n_jobs=1,
+                       n_threads=None):
     """
     Performs a leave-one-out cross-validation such that on each fold one
     input .tfrecord file is used as a validation set.
 
+    The dataset and the model graph are built once. On each fold the input
+    pipelines are switched to the held out file (see Dataset.set_fold) and
+    the model variables are re-initialized, so that the time and memory
+    used to set up a fold do not grow with the number of folds.
+
     Parameters
     ----------
     meta : dict
@@ -54,28 +196,108 @@ def leave_one_subj_out(meta, optimizer_params, graph_specs, model):
     model : mneflow.models.Model
             Class of model to be used
 
+    dataset_params : NoneType, dict, optional
+            Keyword arguments of mneflow.Dataset, e.g. train_batch
+            (defaults to 200). folds is always True.
+
+    train_params : NoneType, dict, optional
+            Keyword arguments of Model.train. Defaults to n_iter=30000,
+            eval_step=250, min_delta=0, early_stopping=3.
+
+    n_jobs : int, optional
+            Number of worker processes. Folds are distributed over the
+            workers, each of which builds the graph once for its folds.
+            With several workers, the model class must be importable (not
+            defined in __main__ of an interactive session). If -1, all CPUs
+            are used. Defaults to 1.
+
+    n_threads : NoneType, int, optional
+            Number of intra- and inter-op threads of the tensorflow session
+            of each worker. If None and n_jobs > 1, the CPUs are divided
+            between the workers, otherwise tensorflow defaults are used.
+            Defaults to None.
+
     Returns
     -------
     results : list of dict
             List of dictionaries, containg final cost and performance estimates
             on each fold of the cross-validation
     """
+    folds = list(range(len(meta['orig_paths'])))
+    fold_opts = dict(meta=meta, optimizer_params=optimizer_params,
+                     graph_specs=graph_specs, model=model,
+                     dataset_params=dataset_params, train_params=train_params)
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if not n_jobs or n_jobs == 1 or len(folds) <= 1:
+        return _run_folds(folds, n_threads=n_threads, **fold_opts)
+    n_jobs = min(n_jobs, len(folds))
+    if n_threads is None:
+        n_threads = max(1, os.cpu_count() // n_jobs)
+    worker = functools.partial(_run_folds, n_threads=n_threads, **fold_opts)
+    chunks = [folds[k::n_jobs] for k in range(n_jobs)]
+    #  Spawn fresh interpreters so that workers do not inherit the
+    #  tensorflow runtime state of the parent process
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx) as executor:
+        chunk_results = list(executor.map(worker, chunks, range(n_jobs)))
+    #  Results are returned in the order of the folds
+    results = [None] * len(folds)
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        for fold, result in zip(chunk, chunk_result):
+            results[fold] = result
+    return results
+
+
+def _run_folds(folds, worker=None, meta=None, optimizer_params=None,
+               graph_specs=None, model=None, dataset_params=None,
+               train_params=None, n_threads=None):
+    """Train and test a model on the given folds of leave_one_subj_out
+
+    Parameters
+    ----------
+    folds : list of int
+        positions of the held out files in meta['orig_paths'].
+
+    worker : NoneType, int
+        number of the worker process. Workers save checkpoints under
+        separate data_id's.
+
+    n_threads : NoneType, int
+        number of intra- and inter-op threads of the session.
+
+    Returns
+    -------
+    results : list of dict
+        results of the folds, see leave_one_subj_out.
+    """
+    if worker is not None:
+        meta = dict(meta, data_id='{}-w{}'.format(meta['data_id'], worker))
+    dataset_opts = dict(train_batch=200, class_subset=None,
+                        pick_channels=None, decim=None)
+    dataset_opts.update(dataset_params or {})
+    dataset_opts['folds'] = True
+    train_opts = dict(n_iter=30000, eval_step=250, min_delta=0,
+                      early_stopping=3)
+    train_opts.update(train_params or {})
+    model_opts = {}
+    if n_threads:
+        model_opts['config'] = tf.ConfigProto(
+            intra_op_parallelism_threads=n_threads,
+            inter_op_parallelism_threads=n_threads)
 
     results = []
     optimizer = Optimizer(**optimizer_params)
-    for i, path in enumerate(meta['orig_paths']):
-        meta_loso = meta.copy()
-        train_fold = [i for i, _ in enumerate(meta['train_paths'])]
-        train_fold.remove(i)
-        meta_loso['train_paths'] = itemgetter(*train_fold)(meta['train_paths'])
-        meta_loso['val_paths'] = itemgetter(*train_fold)(meta['val_paths'])
+    dataset = Dataset(meta, **dataset_opts)
+    m = model(dataset, optimizer, graph_specs, **model_opts)
+    m.build()
+    test_iter, test_handle = m._start_iterator(dataset.test)
+    for i in folds:
+        path = meta['orig_paths'][i]
         print('holdout subj:', path[-10:-9])
-        dataset = Dataset(meta_loso, train_batch=200, class_subset=None,
-                          pick_channels=None, decim=None)
-        m = model(dataset, optimizer, graph_specs)
-        m.build()
-        m.train(n_iter=30000, eval_step=250, min_delta=0, early_stopping=3)
-        test_acc = m.evaluate_performance(path)
+        m.set_fold(i)
+        m.train(**train_opts)
+        _, test_acc, _ = m._run_epoch(test_iter, test_handle)
         print(i, ':', 'test_acc:', test_acc)
         results.append({'val_acc': m.v_acc, 'test_init': test_acc})
         # logger(m, results)
@@ -152,65 +374,249 @@ def scale_to_baseline(X, baseline=None, crop_baseline=False):
     return X
 
 
-def _write_tfrecords(X_, y_, output_file, task='classification'):
-    """Serialize and write datasets in TFRecords fromat
+def _serialize_example(X, y, task='classification', dtype='float32',
+                       quantization=None, clipped=None):
+    """Serialize a single epoch and its label into tf.train.Example
+
+    The data matrix is stored as a single bytes feature containing raw
+    little-endian values of the storage dtype in C order (record schema
+    version 2). See _quantize for clipped.
+    """
+    X = _quantize(X, dtype, quantization, clipped)
+    # Feature contains a map of string to feature proto objects
+    feature = {}
+    feature['X'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[X.tobytes()]))
+    if task == 'classification':
+        feature['y'] = tf.train.Feature(int64_list=tf.train.Int64List(value=y.flatten()))
+    elif task == 'ae':
+        y = y.astype(np.float32)
+        feature['y'] = tf.train.Feature(float_list=tf.train.FloatList(value=y.flatten()))
+    # Construct the Example proto object
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    # Serialize the example to a string
+    return example.SerializeToString()
+
+
+class _ShardWriter(object):
+    """Appends serialized epochs to an open TFRecord shard
+
+    Allows writing a shard incrementally, e.g. one input file at a time,
+    without holding the whole shard in memory. Keeps track of the labels
+    of written records to produce the shard index on closing.
+    """
+    def __init__(self, output_file, task='classification', compression=None,
+                 dtype='float32', quantization=None):
+        self.path = output_file
+        self.task = task
+        self.dtype = dtype
+        self.quantization = quantization
+        #  Number of values clipped by int16 quantization and of all values
+        self.clipped = [0, 0]
+        self.n_records = 0
+        self.labels = []
+        self._writer = tf.python_io.TFRecordWriter(output_file,
+                                                   _record_options(compression))
+
+    def write(self, X_, y_, ind=None):
+        """Serialize and append epochs X_[ind] with labels y_[ind]
+
+        Parameters
+        ----------
+        X_ : ndarray, shape (n_epochs, n_channels, n_timepoints)
+
+        y_ : ndarray, shape (n_epochs,)
+
+        ind : NoneType, ndarray of int, optional
+            Order in which epochs are written. Epochs not in ind are skipped.
+            If None, all epochs are written in the original order.
+        """
+        if ind is None:
+            ind = np.arange(len(y_))
+        for i in ind:
+            self._writer.write(_serialize_example(X_[i], y_[i], self.task,
+                                                  self.dtype,
+                                                  self.quantization,
+                                                  self.clipped))
+            self.n_records += 1
+        if self.task == 'classification':
+            self.labels.extend(np.asarray(y_)[ind].ravel())
+
+    def close(self):
+        """Close the shard and save its index
+
+        Returns
+        -------
+        stats : dict
+            {'n_records', 'n_bytes', 'class_counts'} of the shard.
+        """
+        self._writer.close()
+        _report_clipping(self.path, self.clipped)
+        return _save_index(self.path, self.n_records,
+                           os.path.getsize(self.path), self.labels)
+
+
+class _NpyShardWriter(object):
+    """Appends epochs to an open .npy shard
+
+    Epochs are stored as an array of the storage dtype of shape
+    (n_epochs, n_channels, n_timepoints) that can be memory-mapped with
+    np.load(..., mmap_mode='r'). Labels are stored in a separate
+    '<shard>_labels.npy' file. The .npy header is reserved on opening and
+    filled in on closing, when the number of epochs is known.
+    """
+    header_size = 128
+
+    def __init__(self, output_file, task='classification', compression=None,
+                 dtype='float32', quantization=None):
+        self.path = output_file
+        self.task = task
+        self.dtype = dtype
+        self.quantization = quantization
+        self.clipped = [0, 0]
+        self.n_records = 0
+        self.labels = []
+        self.shape = None
+        self._file = open(output_file, 'wb')
+        self._file.write(b' ' * self.header_size)
+
+    def write(self, X_, y_, ind=None):
+        """Append epochs X_[ind] with labels y_[ind]
+
+        See _ShardWriter.write.
+        """
+        if ind is None:
+            ind = np.arange(len(y_))
+        self.shape = X_.shape[1:]
+        for i in ind:
+            self._file.write(_quantize(X_[i], self.dtype, self.quantization,
+                                       self.clipped).tobytes())
+            self.labels.append(y_[i])
+            self.n_records += 1
+
+    def close(self):
+        """Write the header, labels and the index of the shard
+
+        Returns
+        -------
+        stats : dict
+            {'n_records', 'n_bytes', 'class_counts'} of the shard.
+        """
+        shape = (self.n_records,) + tuple(self.shape or ())
+        self._file.seek(0)
+        self._file.write(_npy_header(shape, _DTYPES[self.dtype][0],
+                                     self.header_size))
+        self._file.close()
+        _report_clipping(self.path, self.clipped)
+        labels = np.array(self.labels)
+        np.save(_labels_path(self.path), labels)
+        return _save_index(self.path, self.n_records,
+                           os.path.getsize(self.path),
+                           labels if self.task == 'classification' else ())
+
+
+def _quantize(X, dtype='float32', quantization=None, clipped=None):
+    """Convert epoch(s) to the storage dtype
 
     Parameters
     ----------
-    X_ : ndarray, shape (n_epochs, n_channels, n_timepoints)
-        (Preprocessed) data matrix.
-    y_ : ndarray, shape (n_epochs,)
-        Class labels.
-    output_file : str
-        Name of the TFRecords file.
+    X : ndarray, shape (..., n_channels, n_timepoints)
+
+    dtype : str {'float32', 'float16', 'int16'}
+
+    quantization : dict
+        per-channel 'scale' and 'offset' used if dtype is 'int16'.
+
+    clipped : NoneType, list
+        [n_clipped, n_values], incremented in place by the number of values
+        clipped to the int16 range and the number of converted values.
+    """
+    if dtype == 'int16':
+        scale = np.asarray(quantization['scale'])[:, None]
+        offset = np.asarray(quantization['offset'])[:, None]
+        X = np.round((X - offset) / scale)
+        if clipped is not None:
+            clipped[0] += np.count_nonzero(np.abs(X) > 32767)
+            clipped[1] += X.size
+        X = np.clip(X, -32767, 32767)
+    return np.ascontiguousarray(X, dtype=_DTYPES[dtype][0])
+
+
+def _fit_quantization(blocks, headroom=2.):
+    """Per-channel scale and offset for int16 quantization
+
+    The offset is the channel mean and the scale maps headroom times the
+    largest deviation from the mean to the int16 range. Values outside of
+    this range are clipped. Statistics are accumulated over blocks, so
+    that a whole input can be used without holding it in memory.
+
+    Parameters
+    ----------
+    blocks : iterable of ndarray, shape (n_epochs, n_channels, n_timepoints)
 
     Returns
     -------
-    TFRecord : TFrecords file.
-    """
-    writer = tf.python_io.TFRecordWriter(output_file)
-    for X, y in zip(X_, y_):
-        X = X.astype(np.float32)
-        # Feature contains a map of string to feature proto objects
-        feature = {}
-        feature['X'] = tf.train.Feature(float_list=tf.train.FloatList(value=X.flatten()))
-        if task == 'classification':
-            feature['y'] = tf.train.Feature(int64_list=tf.train.Int64List(value=y.flatten()))
-        elif task == 'ae':
-            y = y.astype(np.float32)
-            feature['y'] = tf.train.Feature(float_list=tf.train.FloatList(value=y.flatten()))
-        # Construct the Example proto object
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
-        # Serialize the example to a string
-        serialized = example.SerializeToString()
-        # write the serialized object to the disk
-        writer.write(serialized)
-    writer.close()
-
-
-def _split_sets(X, y, val=.1):
-    """Applies shuffle and splits the shuffled data
+    quantization : dict
+        {'scale': list, 'offset': list}
+    """
+    total, n, low, high = 0., 0, np.inf, -np.inf
+    for X in blocks:
+        total = total + X.sum(axis=(0, 2), dtype=np.float64)
+        n += X.shape[0] * X.shape[2]
+        low = np.minimum(low, X.min(axis=(0, 2)))
+        high = np.maximum(high, X.max(axis=(0, 2)))
+    offset = total / n
+    scale = np.maximum(high - offset, offset - low) * headroom / 32767.
+    scale[scale == 0] = 1.
+    return dict(scale=scale.tolist(), offset=offset.tolist())
+
+
+def _report_clipping(path, clipped):
+    """Print the share of values clipped by int16 quantization"""
+    n_clipped, n_values = clipped
+    if n_clipped:
+        print('Clipped {} of {} values ({:.3g}%) of {} to the int16 range'
+              .format(n_clipped, n_values, 100. * n_clipped / n_values, path))
+
+
+def _check_float16(X):
+    """Raise ValueError if X is too small to be stored as float16
+
+    Values below the smallest normal float16 (about 6e-5) lose precision
+    and values below about 6e-8 are stored as zeros, e.g. unscaled MEG
+    data in T.
+    """
+    amplitude = np.std(X)
+    if 0 < amplitude < np.finfo(np.float16).tiny:
+        raise ValueError('Data standard deviation {:.3g} is below float16 '
+                         'precision, use scale=True or dtype=\'int16\''
+                         .format(amplitude))
+
+
+def _npy_header(shape, dtype, size):
+    """Version 1.0 .npy header padded to exactly size bytes"""
+    header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   'fortran_order': False, 'shape': tuple(shape)})
+    header = (header.ljust(size - 11) + '\n').encode('latin1')
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header
+
+
+def _split_indices(n_epochs, val=.1):
+    """Shuffled indices of the training and validation epochs
 
     Parameters
     ----------
-    X : ndarray, shape (n_epochs, n_channels, n_timepoints)
-        (Preprocessed) data matrix.
-    y : ndarray, shape (n_epochs,)
-        Class labels.
+    n_epochs : int
+        Number of epochs.
     val : float from 0 to 1
-        Name of the TFRecords file.
+        Proportion of the epochs used for validation.
 
     Returns
     -------
-    X_train, y_train, X_val, y_val : ndarray
+    train_ind, val_ind : ndarray of int
     """
-    shuffle = np.random.permutation(X.shape[0])
-    val_size = int(round(val*X.shape[0]))
-    X_val = X[shuffle[:val_size], ...]
-    y_val = y[shuffle[:val_size], ...]
-    X_train = X[shuffle[val_size:], ...]
-    y_train = y[shuffle[val_size:], ...]
-    return X_train, y_train, X_val, y_val
+    shuffle = np.random.permutation(n_epochs)
+    val_size = int(round(val*n_epochs))
+    return shuffle[val_size:], shuffle[:val_size]
 
 
 def produce_labels(y, return_stats=True):
@@ -250,7 +656,10 @@ def produce_tfrecords(inputs, savepath, out_name, overwrite=False,
                       scale=False, scale_interval=None, crop_baseline=True,
                       decimate=False, bp_filter=False, picks=None,
                       combine_events=None, task='classification',
-                      array_keys={'X': 'X', 'y': 'y'}):
+                      array_keys={'X': 'X', 'y': 'y'}, n_jobs=1,
+                      compression=None, backend='tfrecord', append=False,
+                      cache_dir=None, cache_size=None, chunk_size=None,
+                      dtype='float32', layout='copy'):
 
     r"""
     Produces TFRecord files from input, applies (optional) preprocessing
@@ -264,6 +673,11 @@ def produce_tfrecords(inputs, savepath, out_name, overwrite=False,
     inputs : list, mne.epochs.Epochs, str
         list of mne.epochs.Epochs or strings with filenames. If input is a
         single string or Epochs object it is firts converted into a list.
+        Supported files are .fif, .npz, .mat and .h5. HDF5-based files
+        (.h5 and MATLAB v7.3 .mat, requires h5py) and arrays stored
+        uncompressed in .npz files are read lazily, so that only the picked
+        channels (and, with chunk_size, only the current block of epochs)
+        are loaded into memory.
 
     savepath : str
         a path where the output TFRecord and corresponding metadata
@@ -274,7 +688,8 @@ def produce_tfrecords(inputs, savepath, out_name, overwrite=False,
 
     savebatch : int
         number of input files per to be stored in the output TFRecord file.
-        Deafults to 1.
+        Inputs are shuffled, split and appended to the output files one at a
+        time, so memory use does not grow with savebatch. Deafults to 1.
 
     save_origs : bool, optinal
         If True, also saves the whole dataset in original order, e.g. for
@@ -323,14 +738,94 @@ def produce_tfrecords(inputs, savepath, out_name, overwrite=False,
         Whether to overwrite the metafile if it already exists at the
         specified path.
 
+    n_jobs : int, optional
+        Number of worker processes used to load, preprocess and serialize
+        the inputs. Each output shard (i.e. each group of 'savebatch'
+        inputs) is processed by a separate worker. If -1, all CPUs are
+        used. Defaults to 1.
+
+    compression : NoneType, str {'GZIP', 'ZLIB'}, optional
+        Compression codec of the output TFRecord files. The codec is stored
+        in meta['compression'] and picked up by mneflow.Dataset. Compression
+        reduces disk footprint and I/O at the cost of CPU time when reading.
+        Defaults to None (no compression).
+
+    backend : str {'tfrecord', 'numpy'}, optional
+        Output format. If 'numpy', each output file is a float32 .npy array
+        of shape (n_epochs, n_channels, n_timepoints) accompanied by
+        '<file>_labels.npy'. mneflow.Dataset then reads the data through
+        memory maps and skips record parsing, which is the fastest option
+        when the dataset resides on a local disk. compression is ignored.
+        Defaults to 'tfrecord'.
+
+    append : bool, optional
+        If True and the metadata file exists, only inputs that have not been
+        processed before are added to the dataset as new output files. Inputs
+        are identified by a fingerprint of the file path, size and
+        modification time (or of the data for in-memory inputs). Output
+        format (backend, compression) follows the existing dataset. The
+        preprocessing parameters must equal those stored in
+        meta['preprocessing'] when the dataset was created, otherwise a
+        ValueError is raised and the dataset must be produced again with
+        overwrite=True. Defaults to False.
+
+    cache_dir : NoneType, str, optional
+        Directory for caching the intermediate results of preprocessing
+        (picked, filtered, scaled and decimated data) of each input. Cache
+        entries are keyed by the input data and the preprocessing
+        parameters, so that e.g. changing only 'decimate' reuses the
+        filtered and scaled data. Defaults to None (no caching).
+
+    cache_size : NoneType, int, optional
+        Maximum size of the cache in bytes. Least recently used entries are
+        removed when the cache exceeds this size. Defaults to None
+        (unlimited).
+
+    chunk_size : NoneType, int, optional
+        If specified, inputs are read, preprocessed and written in blocks of
+        chunk_size epochs, so that memory use is bounded by the block size
+        rather than by the size of the input. .fif files and mne.Epochs are
+        read lazily, array inputs are sliced. Preprocessing is applied to
+        each epoch independently and validation epochs are drawn from the
+        whole input, so the output is the same as without chunking, except
+        that epochs are shuffled within blocks. cache_dir is not used in
+        this mode. Defaults to None.
+
+    dtype : str {'float32', 'float16', 'int16'}, optional
+        Storage dtype of the data. Reduced precision halves disk use and
+        read bandwidth, data are converted back to float32 by
+        mneflow.Dataset. For 'int16', per-channel scale and offset are fitted
+        on the first input (see meta['quantization'], with chunk_size the
+        input is preprocessed twice) and values beyond twice the range
+        observed there are clipped. The share of clipped values is printed
+        for each output file. 'float16' is only suitable for scaled data
+        (scale=True), a ValueError is raised for data below float16
+        precision. Defaults to 'float32'.
+
+    layout : str {'copy', 'index'}, optional
+        'copy' writes separate shuffled training and validation files (and
+        original-order files if save_origs is True). 'index' writes each
+        epoch once into a '_store_' file per output shard, training and
+        validation sets are defined by record indices stored next to it
+        (.split.npz, see mneflow.data._load_split) and built as views by
+        mneflow.Dataset. The whole store serves as the 'orig' set, with
+        epochs shuffled within each input (or block), so the original order
+        is not kept and save_origs is ignored. Meta['train_paths'],
+        meta['val_paths'] and meta['orig_paths'] then point to the same
+        files. Defaults to 'copy'.
+
     Returns
     -------
     meta : dict
         metadata associated with the processed dataset. Contains all the
         information about the dataset required for further processing with
-        mneflow.
+        mneflow. meta['shards'] maps the path of each output file to its
+        number of records, size in bytes and per-class record counts.
         Whenever the function is called the copy of metadata is also saved to
-        savepath/meta.pkl so it can be restored at any time.
+        savepath/<out_name>_meta.json (with per-shard records in
+        <out_name>_shards.jsonl) so it can be restored at any time using
+        load_meta. Metadata pickled by earlier versions are still loaded
+        and converted when appending.
 
 
 
@@ -348,123 +843,848 @@ def produce_tfrecords(inputs, savepath, out_name, overwrite=False,
 
     if not os.path.exists(savepath):
         os.mkdir(savepath)
-    if overwrite or not os.path.exists(savepath+out_name+'_meta.pkl'):
-        from mne import epochs as mnepochs, filter as mnefilt, pick_types
-        meta = dict(train_paths=[], val_paths=[], orig_paths=[],
-                    data_id=out_name, val_size=0, task=task)
-        jj = 0
-        i = 0
+    meta_exists = (os.path.exists(savepath+out_name+'_meta.json')
+                   or os.path.exists(savepath+out_name+'_meta.pkl'))
+    if overwrite or not meta_exists or append:
         if not isinstance(inputs, list):
             inputs = [inputs]
-        #  Import data and labels
-        for inp in inputs:
-            if isinstance(inp, mnepochs.BaseEpochs):
-                print('processing epochs')
-                inp.load_data()
-                data = inp.get_data()
-                events = inp.events[:, 2]
-                fs = inp.info['sfreq']
-                if isinstance(picks,dict):
-                        picks = pick_types(inp.info,**picks)
-            elif isinstance(inp, tuple) and len(inp) == 2:
-                data, events = inp
-            elif isinstance(inp, str):
-                fname = inp
-                print(fname[-3:])
-                if fname[-3:] == 'fif':
-                    epochs = mnepochs.read_epochs(fname, preload=True,
-                                                  verbose='CRITICAL')
-                    if isinstance(picks,dict):
-                        picks = pick_types(epochs.info,**picks)
-                    events = epochs.events[:, 2]
-                    fs = epochs.info['sfreq']
-                    data = epochs.get_data()
-                else:
-                    if fname[-3:] == 'mat':
-                        datafile = sio.loadmat(fname)
+        prep_opts = dict(fs=fs, scale=scale, scale_interval=scale_interval,
+                         crop_baseline=crop_baseline, decimate=decimate,
+                         bp_filter=bp_filter, picks=picks,
+                         combine_events=combine_events, task=task,
+                         array_keys=array_keys)
+        #  Parameters that change the stored epochs, array_keys only
+        #  locates the data in the inputs
+        preprocessing = {key: val for key, val in prep_opts.items()
+                         if key != 'array_keys'}
+        fingerprints = [_input_key(inp).hexdigest() for inp in inputs]
+        if append and meta_exists and not overwrite:
+            meta = load_meta(savepath, data_id=out_name, shards=True)
+            if meta.get('schema_version', 1) != SCHEMA_VERSION:
+                print('Cannot append to a dataset with record schema',
+                      meta.get('schema_version', 1))
+                return meta
+            if 'preprocessing' not in meta:
+                print('Preprocessing of the existing dataset is not stored,',
+                      'assuming the current parameters')
+                meta['preprocessing'] = preprocessing
+            elif _canonical(meta['preprocessing']) != _canonical(preprocessing):
+                changed = sorted(
+                    key for key in set(preprocessing) | set(meta['preprocessing'])
+                    if _canonical(preprocessing.get(key))
+                    != _canonical(meta['preprocessing'].get(key)))
+                raise ValueError('Cannot append with preprocessing parameters '
+                                 '{} differing from the existing dataset, '
+                                 'use overwrite=True to produce it again'
+                                 .format(', '.join(changed)))
+            #  Output format must match the existing shards
+            compression = meta.get('compression', '')
+            backend = meta.get('backend', 'tfrecord')
+            dtype = meta.get('dtype', 'float32')
+            layout = meta.get('layout', 'copy')
+            ingested = set(meta.setdefault('fingerprints', []))
+            new = [k for k, fp in enumerate(fingerprints)
+                   if fp not in ingested]
+            print('Appending {} new inputs, skipping {} ingested'
+                  .format(len(new), len(inputs) - len(new)))
+            inputs = [inputs[k] for k in new]
+            fingerprints = [fingerprints[k] for k in new]
+            if not os.path.exists(savepath+out_name+'_meta.json'):
+                #  Convert pickled metadata of earlier versions
+                _save_meta(meta, savepath, out_name)
+        else:
+            meta = dict(train_paths=[], val_paths=[], orig_paths=[],
+                        data_id=out_name, val_size=0, task=task,
+                        schema_version=SCHEMA_VERSION,
+                        compression=(compression or '').upper(),
+                        backend=backend, dtype=dtype, layout=layout,
+                        preprocessing=preprocessing, fingerprints=[])
+            _save_meta(meta, savepath, out_name)
+        #  Each output shard is produced from 'savebatch' consecutive inputs
+        shards = [inputs[k:k+savebatch]
+                  for k in range(0, len(inputs), savebatch)]
+        fingerprints = [fingerprints[k:k+savebatch]
+                        for k in range(0, len(inputs), savebatch)]
+        #  New shards are numbered after the existing ones
+        first_shard = len(meta['train_paths'])
+        shard_opts = dict(savepath=savepath, out_name=out_name,
+                          save_origs=save_origs, val_size=val_size,
+                          compression=compression, backend=backend,
+                          cache_dir=cache_dir, cache_size=cache_size,
+                          chunk_size=chunk_size, dtype=dtype,
+                          quantization=meta.get('quantization'),
+                          layout=layout, **prep_opts)
+        if dtype == 'float16' and not scale:
+            print("Warning: dtype='float16' is only suitable for scaled data",
+                  '(scale=True)')
+        if dtype == 'int16' and not shard_opts['quantization'] and shards:
+            #  Quantization is fitted on the first input and shared by all
+            #  other shards
+            _run_shards(meta, shards[:1], fingerprints[:1], shard_opts,
+                        savepath, out_name, first_shard=first_shard)
+            if 'quantization' not in meta:
+                return meta
+            shard_opts['quantization'] = meta['quantization']
+            shards, fingerprints = shards[1:], fingerprints[1:]
+            first_shard += 1
+        if n_jobs is not None and n_jobs < 0:
+            n_jobs = os.cpu_count()
+        if not n_jobs or n_jobs == 1 or len(shards) <= 1:
+            _run_shards(meta, shards, fingerprints, shard_opts, savepath,
+                        out_name, first_shard=first_shard)
+        else:
+            #  Spawn fresh interpreters so that workers do not inherit the
+            #  tensorflow runtime state of the parent process
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(shards)),
+                                     mp_context=ctx) as executor:
+                _run_shards(meta, shards, fingerprints, shard_opts, savepath,
+                            out_name, first_shard=first_shard,
+                            executor=executor)
+
+    elif meta_exists:
+        print('Metadata file found, restoring')
+        meta = load_meta(savepath, data_id=out_name, shards=True)
+    return meta
 
-                    if fname[-3:] == 'npz':
-                        datafile = np.load(fname)
 
-                    data = datafile[array_keys['X']]
-                    events = datafile[array_keys['y']]
-            if not fs:
-                print('Specify sampling frequency')
-                return
+def _run_shards(meta, shards, fingerprints, shard_opts, savepath, out_name,
+                first_shard=0, executor=None):
+    """Produce output shards and merge their metadata into meta
+
+    Parameters
+    ----------
+    meta : dict
+        metadata dictionary, updated in place.
+
+    shards : list of lists
+        inputs grouped by output shard.
+
+    fingerprints : list of lists
+        fingerprints of the inputs, grouped by output shard.
+
+    shard_opts : dict
+        keyword arguments passed to _process_shard.
+
+    first_shard : int
+        number of the first output shard.
+
+    executor : NoneType, concurrent.futures.Executor
+        If None shards are processed sequentially in the current process.
+    """
+    worker = functools.partial(_process_shard, **shard_opts)
+    shard_ids = range(first_shard, first_shard + len(shards))
+    if executor is None:
+        results = map(worker, shard_ids, shards)
+    else:
+        results = executor.map(worker, shard_ids, shards)
+    #  Results are merged in the order of the shards so that metadata is
+    #  identical to the one produced sequentially
+    for shard_meta, shard_fingerprints in zip(results, fingerprints):
+        if shard_meta is None:
+            break
+        _merge_shard_meta(meta, shard_meta)
+        meta['fingerprints'].extend(shard_fingerprints)
+        _append_meta(meta, savepath, out_name, shard_meta['train_path'],
+                     shard_meta['shards'], shard_fingerprints)
+
+
+def _input_key(inp):
+    """Hash identifying the data of an input
+
+    Files are identified by their path, size and modification time, other
+    inputs by a hash of their data.
+
+    Returns
+    -------
+    key : hashlib.sha1
+    """
+    from mne import epochs as mnepochs
+    key = hashlib.sha1()
+    if isinstance(inp, str):
+        stat = os.stat(inp)
+        key.update(repr((os.path.abspath(inp), stat.st_size,
+                         stat.st_mtime)).encode())
+    elif isinstance(inp, mnepochs.BaseEpochs):
+        if inp.preload or not inp.filename:
+            key.update(np.ascontiguousarray(inp.get_data()).data)
+        else:
+            stat = os.stat(inp.filename)
+            key.update(repr((os.path.abspath(inp.filename), stat.st_size,
+                             stat.st_mtime)).encode())
+        key.update(np.ascontiguousarray(inp.selection).data)
+    else:
+        for arr in inp:
+            key.update(np.ascontiguousarray(arr).data)
+    return key
+
+
+def _canonical(obj):
+    """Order-independent representation of (nested) parameters"""
+    if isinstance(obj, dict):
+        return sorted((repr(k), _canonical(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _merge_shard_meta(meta, shard_meta):
+    """Merge metadata of a single output shard into the dataset metadata"""
+    meta['train_paths'].append(shard_meta['train_path'])
+    meta['val_paths'].append(shard_meta['val_path'])
+    if shard_meta['orig_path']:
+        meta['orig_paths'].append(shard_meta['orig_path'])
+    meta['val_size'] += shard_meta['val_size']
+    meta.setdefault('shards', {}).update(shard_meta['shards'])
+    for key in ['fs', 'n_ch', 'n_t', 'y_shape', 'class_proportions',
+                'orig_classes', 'n_classes', 'quantization']:
+        if key in shard_meta:
+            meta[key] = shard_meta[key]
+
+
+def _load_input(inp, fs=None, picks=None, array_keys={'X': 'X', 'y': 'y'},
+                combine_events=None):
+    """Import data and labels from a single input
+
+    Parameters
+    ----------
+    inp : mne.epochs.Epochs, tuple, str
+        Epochs object, (data, events) tuple or path to .fif, .mat or .npz
+        file.
+
+    fs : float, optional
+        Sampling frequency, used if inp is not an mne.Epochs object.
+
+    picks : NoneType, ndarray of int, dict, optional
+        If dict, channels are picked using mne.pick_types.
+
+    combine_events : NoneType, dict, optional
+        If specified, only epochs of the classes combined by
+        _combine_labels are read.
+
+    Returns
+    -------
+    data : ndarray, shape (n_epochs, n_channels, n_timepoints)
+
+    events : ndarray, shape (n_epochs,)
+
+    fs : float
+
+    picks : NoneType, ndarray of int
+    """
+    data, events, fs, picks = _open_input(inp, fs=fs, picks=picks,
+                                          array_keys=array_keys)
+    try:
+        if combine_events:
+            _, keep_ind = _combine_labels(events, combine_events)
+            return np.asarray(data[keep_ind]), events[keep_ind], fs, picks
+        return np.asarray(data[:]), events, fs, picks
+    finally:
+        _close_input(data)
+
+
+def _open_input(inp, fs=None, picks=None, array_keys={'X': 'X', 'y': 'y'}):
+    """Open a single input without loading the data where possible
 
-            #  IMPORT ENDS HERE!
-            meta['fs'] = fs
-            if isinstance(picks, np.ndarray):
-                data = data[:, picks, :]
-            # Preprocessing
-            if bp_filter:
-                data = mnefilt.filter_data(data, fs, l_freq=bp_filter[0],
-                                           h_freq=bp_filter[1],
-                                           method='iir', verbose=False)
-            if scale:
-                data = scale_to_baseline(data, scale_interval, crop_baseline)
-
-            if decimate:
-                data = data[..., ::decimate]
-                meta['fs'] /= decimate
+    Same as _load_input, except that the data of mne.Epochs objects and
+    .fif files are read only when indexed.
+
+    Returns
+    -------
+    data : ndarray, _LazyEpochs
+        data indexable along the first (epochs) dimension.
+
+    events : ndarray, shape (n_epochs,)
+
+    fs : float
+
+    picks : NoneType, ndarray of int
+    """
+    from mne import epochs as mnepochs, pick_types
+    if isinstance(inp, mnepochs.BaseEpochs):
+        print('processing epochs')
+        data = _LazyEpochs(inp)
+        events = inp.events[:, 2]
+        fs = inp.info['sfreq']
+        if isinstance(picks, dict):
+            picks = pick_types(inp.info, **picks)
+    elif isinstance(inp, tuple) and len(inp) == 2:
+        data, events = inp
+    elif isinstance(inp, str):
+        fname = inp
+        print(fname[-3:])
+        if fname[-3:] == 'fif':
+            epochs = mnepochs.read_epochs(fname, preload=False,
+                                          verbose='CRITICAL')
+            epochs.drop_bad()
+            if isinstance(picks, dict):
+                picks = pick_types(epochs.info, **picks)
+            events = epochs.events[:, 2]
+            fs = epochs.info['sfreq']
+            data = _LazyEpochs(epochs)
+        elif fname[-3:] in ['mat', '.h5', 'df5'] and _is_hdf5(fname):
+            data, events = _open_hdf5(fname, array_keys,
+                                      matlab=fname[-3:] == 'mat')
+        elif fname[-3:] == 'npz':
+            data = _open_npz_member(fname, array_keys['X'])
+            with np.load(fname) as datafile:
+                events = datafile[array_keys['y']]
+        elif fname[-3:] == 'mat':
+            datafile = sio.loadmat(fname)
+            data = datafile[array_keys['X']]
+            events = datafile[array_keys['y']]
+        elif fname[-3:] in ['.h5', 'df5']:
+            raise ValueError('{} is not an HDF5 file'.format(fname))
+        else:
+            raise ValueError('Unsupported input file {}, expected .fif, '
+                             '.mat, .h5, .hdf5 or .npz'.format(fname))
+    if isinstance(data, _LazyArray) and isinstance(picks, np.ndarray):
+        #  Read only the picked channels
+        data.picks = picks
+        picks = None
+    return data, events, fs, picks
+
+
+def _is_hdf5(fname):
+    """Check for the HDF5 signature, e.g. of MATLAB v7.3 files"""
+    with open(fname, 'rb') as f:
+        for offset in [0, 512, 1024, 2048]:
+            f.seek(offset)
+            if f.read(8) == b'\x89HDF\r\n\x1a\n':
+                return True
+    return False
+
+
+def _open_hdf5(fname, array_keys={'X': 'X', 'y': 'y'}, matlab=False):
+    """Open data and labels stored in an HDF5 (.h5 or v7.3 .mat) file
+
+    Returns
+    -------
+    data : _LazyArray
+        data read from the file when indexed. The file stays open until
+        data.close() is called.
+
+    events : ndarray, shape (n_epochs,)
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is required for reading HDF5-based files '
+                          '(.h5, MATLAB v7.3 .mat)')
+    datafile = h5py.File(fname, 'r')
+    try:
+        events = np.asarray(datafile[array_keys['y']]).ravel()
+        data = _LazyArray(datafile[array_keys['X']], matlab=matlab,
+                          datafile=datafile)
+    except Exception:
+        datafile.close()
+        raise
+    return data, events
+
+
+def _close_input(data):
+    """Close the file of an input opened by _open_input, if any"""
+    if isinstance(data, _LazyArray):
+        data.close()
+
+
+def _open_npz_member(fname, key):
+    """Memory-map an array stored in an .npz file
+
+    Arrays stored without compression (np.savez) are memory-mapped,
+    compressed arrays (np.savez_compressed) are loaded.
+
+    Returns
+    -------
+    data : _LazyArray, ndarray
+    """
+    with zipfile.ZipFile(fname) as archive:
+        info = archive.getinfo(key + '.npy')
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(fname, 'rb') as f:
+            #  Skip the local file header of the member
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(name_len + extra_len, 1)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                header = np.lib.format.read_array_header_2_0(f)
+            else:
+                header = None
+            offset = f.tell()
+        if header and not header[2].hasobject:
+            shape, fortran_order, dtype = header
+            data = np.memmap(fname, dtype=dtype, mode='r', shape=shape,
+                             order='F' if fortran_order else 'C',
+                             offset=offset)
+            return _LazyArray(data)
+    with np.load(fname) as datafile:
+        return datafile[key]
+
+
+class _LazyArray(object):
+    """Reads epochs of an on-disk array only when they are indexed
+
+    Parameters
+    ----------
+    array : np.memmap, h5py.Dataset
+        array of shape (n_epochs, n_channels, n_timepoints).
+
+    matlab : bool
+        If True, the array is stored as (n_timepoints, n_channels,
+        n_epochs) as in MATLAB v7.3 files.
+
+    picks : NoneType, ndarray of int
+        channels to read.
+
+    datafile : NoneType, h5py.File
+        file containing the array, closed by close.
+    """
+    def __init__(self, array, matlab=False, picks=None, datafile=None):
+        self.array = array
+        self.matlab = matlab
+        self.picks = picks
+        self.datafile = datafile
+
+    def close(self):
+        """Close the file containing the array"""
+        if self.datafile is not None:
+            self.datafile.close()
+            self.datafile = None
+
+    def __len__(self):
+        return self.array.shape[-1] if self.matlab else self.array.shape[0]
+
+    def __getitem__(self, ind):
+        picks = self.picks
+        if picks is not None:
+            #  HDF5 supports only increasing indices
+            picks, order = np.unique(picks, return_inverse=True)
+        if picks is None or isinstance(ind, slice):
+            data = self._read(ind, picks)
+        else:
+            #  HDF5 supports a single index list per selection, channels
+            #  are picked after reading the epochs
+            data = self._read(ind, None)[:, picks, :]
+        if picks is not None:
+            data = data[:, order, :]
+        if not data.flags.writeable:
+            #  Slices of memory maps are read-only views, preprocessing
+            #  modifies the data in place
+            data = np.array(data)
+        return data
+
+    def _read(self, ind, picks=None):
+        """Read epochs ind and channels picks as (epochs, channels, times)"""
+        channels = slice(None) if picks is None else picks
+        if self.matlab:
+            return np.asarray(self.array[:, channels, ind]).transpose([2, 1, 0])
+        return np.asarray(self.array[ind, channels, :])
+
+
+class _LazyEpochs(object):
+    """Reads epochs of an mne.Epochs object only when they are indexed"""
+    def __init__(self, epochs):
+        self.epochs = epochs
+
+    def __len__(self):
+        return len(self.epochs.events)
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice) and ind == slice(None):
+            return self.epochs.get_data()
+        return self.epochs[ind].get_data()
+
+
+def _iter_blocks(data, ind, chunk_size):
+    """Read epochs data[ind] in blocks of at most chunk_size epochs
+
+    ind must be increasing. Runs of consecutive epochs are read as slices,
+    other blocks by their list of indices, so that at most chunk_size
+    epochs are read at once.
+
+    Yields
+    ------
+    block : ndarray, shape (n_block_epochs, n_channels, n_timepoints)
+
+    start : int
+        position of the first epoch of the block in ind.
+    """
+    for start in range(0, len(ind), chunk_size):
+        block_ind = ind[start:start+chunk_size]
+        if block_ind[-1] - block_ind[0] + 1 == len(block_ind):
+            block = data[block_ind[0]:block_ind[-1]+1]
+        else:
+            block = data[np.asarray(block_ind)]
+        yield np.asarray(block), start
+
+
+class _PreprocessingCache(object):
+    """On-disk cache of preprocessed inputs
+
+    Entries are keyed by a hash of the input data and of the parameters of
+    all preprocessing stages applied to it, so that an entry is valid as
+    long as the key matches. If the total size of the cache exceeds
+    max_size bytes, least recently used entries are evicted.
+    """
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, parent, **params):
+        """Key of the output of a stage applied to the entry parent
+
+        Parameters
+        ----------
+        parent : str, hashlib.sha1
+            key of the input of the stage.
+
+        params : dict
+            parameters of the stage.
+        """
+        if not isinstance(parent, str):
+            parent = parent.hexdigest()
+        key = hashlib.sha1(parent.encode())
+        key.update(repr(_canonical(params)).encode())
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Cached (data, events, fs) or None if key is not in the cache"""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                cached = entry['data'], entry['events'], float(entry['fs'])
+            #  Modification time tracks the last use of the entry
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return cached
+
+    def put(self, key, data, events, fs):
+        """Store an entry and evict old entries if necessary"""
+        path = self._path(key)
+        #  Write to a temporary file first so that concurrent readers never
+        #  see a partially written entry
+        tmp = path[:-len('.npz')] + '.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp, data=data, events=events, fs=fs)
+        os.replace(tmp, path)
+        if self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until within max_size"""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.npz') and not fname.endswith('.tmp.npz'):
+                path = os.path.join(self.cache_dir, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def _preprocess_input(inp, fs=None, picks=None, array_keys={'X': 'X', 'y': 'y'},
+                      bp_filter=False, scale=False, scale_interval=None,
+                      crop_baseline=True, decimate=False, combine_events=None,
+                      cache=None):
+    """Load and preprocess a single input
+
+    Preprocessing stages are applied in the following order: channel
+    picking, band-pass filtering, scaling and decimation. If cache is
+    specified, the output of each stage is cached and processing starts
+    from the output of the last cached stage. If combine_events is
+    specified, only the epochs of the combined classes are read (see
+    _load_input).
+
+    Returns
+    -------
+    data : ndarray, shape (n_epochs, n_channels, n_timepoints)
+        preprocessed data.
+
+    events : ndarray, shape (n_epochs,)
+
+    fs : float
+        sampling frequency after decimation.
+
+    Returns None if the sampling frequency is not specified.
+    """
+    stages = [('picked', dict(picks=picks, array_keys=array_keys, fs=fs,
+                              combine_events=combine_events)),
+              ('filtered', dict(bp_filter=bp_filter)),
+              ('scaled', dict(scale=scale, scale_interval=scale_interval,
+                              crop_baseline=crop_baseline)),
+              ('decimated', dict(decimate=decimate))]
+    active = [True, bool(bp_filter), bool(scale), bool(decimate)]
+    keys = []
+    start = 0
+    if cache:
+        key = _input_key(inp)
+        for name, params in stages:
+            key = cache.key(key, stage=name, **params)
+            keys.append(key)
+        #  Resume from the output of the last cached stage
+        for k in range(len(stages) - 1, -1, -1):
+            if not active[k]:
+                continue
+            cached = cache.get(keys[k])
+            if cached is not None:
+                data, events, fs = cached
+                start = k + 1
+                break
+    if start == 0:
+        data, events, fs, picks = _load_input(inp, fs=fs, picks=picks,
+                                              array_keys=array_keys,
+                                              combine_events=combine_events)
+        if not fs:
+            return
+        if isinstance(picks, np.ndarray):
+            data = data[:, picks, :]
+        if cache:
+            cache.put(keys[0], data, events, fs)
+        start = 1
+    for k in range(start, len(stages)):
+        if not active[k]:
+            continue
+        data, fs = _apply_stage(stages[k][0], data, fs, bp_filter=bp_filter,
+                                scale_interval=scale_interval,
+                                crop_baseline=crop_baseline,
+                                decimate=decimate)
+        if cache:
+            cache.put(keys[k], data, events, fs)
+    return data, events, fs
+
+
+def _apply_stage(stage, data, fs, bp_filter=False, scale_interval=None,
+                 crop_baseline=True, decimate=False):
+    """Apply a single preprocessing stage, see _preprocess_input
+
+    Returns
+    -------
+    data : ndarray
+
+    fs : float
+        sampling frequency after the stage.
+    """
+    from mne import filter as mnefilt
+    if stage == 'filtered':
+        data = mnefilt.filter_data(data, fs, l_freq=bp_filter[0],
+                                   h_freq=bp_filter[1],
+                                   method='iir', verbose=False)
+    elif stage == 'scaled':
+        data = scale_to_baseline(data, scale_interval, crop_baseline)
+    elif stage == 'decimated':
+        data = data[..., ::decimate]
+        fs /= decimate
+    return data, fs
+
+
+def _preprocess_block(data, fs, picks=None, bp_filter=False, scale=False,
+                      scale_interval=None, crop_baseline=True,
+                      decimate=False):
+    """Preprocess a block of epochs, see _preprocess_input
+
+    Returns
+    -------
+    data : ndarray, shape (n_epochs, n_channels, n_timepoints)
+    """
+    if isinstance(picks, np.ndarray):
+        data = data[:, picks, :]
+    for stage, active in [('filtered', bp_filter), ('scaled', scale),
+                          ('decimated', decimate)]:
+        if active:
+            data, fs = _apply_stage(stage, data, fs, bp_filter=bp_filter,
+                                    scale_interval=scale_interval,
+                                    crop_baseline=crop_baseline,
+                                    decimate=decimate)
+    return data
+
+
+def _process_shard(jj, shard_inputs, savepath, out_name, save_origs=False,
+                   val_size=0.2, fs=None, scale=False, scale_interval=None,
+                   crop_baseline=True, decimate=False, bp_filter=False,
+                   picks=None, combine_events=None, task='classification',
+                   array_keys={'X': 'X', 'y': 'y'}, compression=None,
+                   backend='tfrecord', cache_dir=None, cache_size=None,
+                   chunk_size=None, dtype='float32', quantization=None,
+                   layout='copy'):
+    """Load, preprocess and write inputs of a single output shard
+
+    Runs independently of other shards and can thus be executed in a
+    worker process. See produce_tfrecords for the description of the
+    parameters.
+
+    Returns
+    -------
+    shard_meta : dict, NoneType
+        metadata of the produced shard, None if an input could not be
+        processed.
+    """
+    shard_meta = dict(val_size=0, orig_path=None)
+    if backend == 'numpy':
+        Writer, ext = _NpyShardWriter, '.npy'
+    else:
+        Writer, ext = _ShardWriter, '.tfrecord'
+    writer_opts = dict(task=task, compression=compression, dtype=dtype,
+                       quantization=quantization)
+    if layout == 'index':
+        #  Each epoch is written once, splits are stored as record indices
+        store_path = ''.join([savepath, out_name, '_store_', str(jj), ext])
+        shard_meta['train_path'] = store_path
+        shard_meta['val_path'] = store_path
+        shard_meta['orig_path'] = store_path
+        writers = dict(store=Writer(store_path, **writer_opts))
+        split = dict(train=[], val=[])
+    else:
+        shard_meta['train_path'] = ''.join([savepath, out_name, '_train_',
+                                            str(jj), ext])
+        shard_meta['val_path'] = ''.join([savepath, out_name, '_val_',
+                                          str(jj), ext])
+        writers = dict(train=Writer(shard_meta['train_path'], **writer_opts),
+                       val=Writer(shard_meta['val_path'], **writer_opts))
+    if save_origs and layout != 'index':
+        shard_meta['orig_path'] = ''.join([savepath, out_name, '_orig_',
+                                           str(jj), ext])
+        writers['orig'] = Writer(shard_meta['orig_path'], **writer_opts)
+    print('Saving TFRecord# {}'.format(jj))
+    if cache_dir:
+        cache = _PreprocessingCache(cache_dir, max_size=cache_size)
+    else:
+        cache = None
+    try:
+        for inp in shard_inputs:
+            if chunk_size:
+                #  Data are read and preprocessed block by block below
+                data, events, input_fs, input_picks = _open_input(inp, fs=fs,
+                                                                  picks=picks,
+                                                                  array_keys=array_keys)
+                if not input_fs:
+                    print('Specify sampling frequency')
+                    return
+                shard_meta['fs'] = input_fs / decimate if decimate else input_fs
+            else:
+                preprocessed = _preprocess_input(inp, fs=fs, picks=picks,
+                                                 array_keys=array_keys,
+                                                 bp_filter=bp_filter,
+                                                 scale=scale,
+                                                 scale_interval=scale_interval,
+                                                 crop_baseline=crop_baseline,
+                                                 decimate=decimate,
+                                                 combine_events=(combine_events
+                                                                 if task == 'classification'
+                                                                 else None),
+                                                 cache=cache)
+                if preprocessed is None:
+                    print('Specify sampling frequency')
+                    return
+                data, events, shard_meta['fs'] = preprocessed
 
             if len(np.unique(events)) == 1:
                 print('Events contain only one class!')
-                break
+                return
+            keep_ind = np.arange(len(events))
             if task == 'classification':
                 if combine_events:
                     events, keep_ind = _combine_labels(events, combine_events)
-                    data = data[keep_ind, ...]
                     events = events[keep_ind]
 
-                labels, total_counts, meta['class_proportions'], meta['orig_classes'] = produce_labels(events)
-                meta['n_classes'] = len(meta['class_proportions'])
-                print('n_classes:', meta['n_classes'], ':', np.unique(labels))
+                labels, total_counts, class_proportions, orig_classes = produce_labels(events)
+                shard_meta['class_proportions'] = class_proportions
+                shard_meta['orig_classes'] = orig_classes
+                shard_meta['n_classes'] = len(class_proportions)
+                print('n_classes:', shard_meta['n_classes'], ':',
+                      np.unique(labels))
 
             elif task == 'regression':
                 print('Not Implemented')
 
-            i += 1
-            if i == 1:
-                X = data
-                y = labels
-            elif i > 1:
-                X = np.concatenate([X, data])
-                y = np.concatenate([y, labels])
-
-            meta['y_shape'] = y.shape[1:]
-
-            if i % savebatch == 0 or jj*savebatch + i == len(inputs):
-                print('data shape: ', X.shape)
-                print('Saving TFRecord# {}'.format(jj))
-                X = X.astype(np.float32)
-                n_trials, meta['n_ch'], meta['n_t'] = X.shape
-                X_train, y_train, X_val, y_val = _split_sets(X, y, val=val_size)
-                meta['val_size'] += len(y_val)
-                meta['train_paths'].append(''.join([savepath, out_name,
-                                                    '_train_', str(jj),
-                                                    '.tfrecord']))
-                _write_tfrecords(X_train, y_train, meta['train_paths'][-1],
-                                task=task)
-                meta['val_paths'].append(''.join([savepath, out_name,
-                                                 '_val_', str(jj),
-                                                  '.tfrecord']))
-                _write_tfrecords(X_val, y_val, meta['val_paths'][-1], task=task)
-                if save_origs:
-                    meta['orig_paths'].append(''.join([savepath, out_name,
-                                                       '_orig_', str(jj),
-                                                       '.tfrecord']))
-                    _write_tfrecords(X, y, meta['orig_paths'][-1], task=task)
-                jj += 1
-                i = 0
-                del X, y
-            with open(savepath+out_name+'_meta.pkl', 'wb') as f:
-                pickle.dump(meta, f)
-
-    elif os.path.exists(savepath+out_name+'_meta.pkl'):
-        print('Metadata file found, restoring')
-        meta = load_meta(savepath, data_id=out_name)
-    return meta
+            if chunk_size:
+                preprocess = functools.partial(_preprocess_block, fs=input_fs,
+                                               picks=input_picks,
+                                               bp_filter=bp_filter,
+                                               scale=scale,
+                                               scale_interval=scale_interval,
+                                               crop_baseline=crop_baseline,
+                                               decimate=decimate)
+                blocks = ((preprocess(block), start) for block, start
+                          in _iter_blocks(data, keep_ind, chunk_size))
+            else:
+                #  Epochs of other classes were not read by
+                #  _preprocess_input, keep_ind selects all epochs
+                blocks = [(data, 0)]
+            if dtype == 'int16' and not quantization:
+                #  Fitted on the whole first input
+                if chunk_size:
+                    fit_blocks = (preprocess(block) for block, _
+                                  in _iter_blocks(data, keep_ind, chunk_size))
+                else:
+                    fit_blocks = (block for block, _ in blocks)
+                quantization = _fit_quantization(fit_blocks)
+                shard_meta['quantization'] = quantization
+                for writer in writers.values():
+                    writer.quantization = quantization
+            #  Validation epochs are drawn once per input, so that the split
+            #  does not depend on chunk_size
+            _, val_ind = _split_indices(len(labels), val=val_size)
+            is_val = np.zeros(len(labels), bool)
+            is_val[val_ind] = True
+            #  Shuffle, split and append the epochs of each input (or
+            #  block) as they arrive, so that only one input (or block) is
+            #  kept in memory
+            for block, start in blocks:
+                block_labels = labels[start:start+len(block)]
+                print('data shape: ', block.shape)
+                _, shard_meta['n_ch'], shard_meta['n_t'] = block.shape
+                shard_meta['y_shape'] = labels.shape[1:]
+                if dtype == 'float16':
+                    _check_float16(block)
+                shuffle = np.random.permutation(len(block))
+                block_val = is_val[start:start+len(block)][shuffle]
+                train_ind, val_ind = shuffle[~block_val], shuffle[block_val]
+                shard_meta['val_size'] += len(val_ind)
+                if layout == 'index':
+                    #  Training epochs are written first (shuffled), followed
+                    #  by the validation epochs
+                    order = np.concatenate([train_ind, val_ind])
+                    first = writers['store'].n_records
+                    writers['store'].write(block, block_labels, order)
+                    split['train'].append(first + np.arange(len(train_ind)))
+                    split['val'].append(first + np.arange(len(train_ind),
+                                                          len(order)))
+                else:
+                    writers['train'].write(block, block_labels, train_ind)
+                    writers['val'].write(block, block_labels, val_ind)
+                    if save_origs:
+                        writers['orig'].write(block, block_labels)
+            _close_input(data)
+            del data, labels, blocks
+    finally:
+        shard_meta['shards'] = {writer.path: writer.close()
+                                for writer in writers.values()}
+    if layout == 'index':
+        _save_split(store_path, **{key: np.concatenate(val or [[]])
+                                   for key, val in split.items()})
+    return shard_meta
 
 
 def _combine_labels(labels, new_mapping):